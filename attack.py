@@ -1,16 +1,22 @@
-from classifier import train as train_model, get_predictions
-from utilities import log_loss, prety_print_result, get_inference_threshold, generate_noise, get_random_features, get_attribute_variations
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import roc_curve
-from scipy import stats
+from utilities import log_loss, prety_print_result, top_k_scores, get_inference_threshold, generate_noise, create_noise_bank, add_noise, get_random_features, get_attribute_variations, profile_phase, is_resumable_model, lazy_import
+from constants import SEED
+from multiprocessing.pool import ThreadPool
+from scipy import sparse, special
 import numpy as np
-import tensorflow as tf
 import argparse
 import os
 import pickle
 
+# TensorFlow is only imported once a model is trained, so that preparing the data starts quickly
+models = lazy_import('classifier')
+model_selection = lazy_import('sklearn.model_selection')
+metrics = lazy_import('sklearn.metrics')
+stats = lazy_import('scipy.stats')
+optimize = lazy_import('scipy.optimize')
+
 MODEL_PATH = 'model/'
 DATA_PATH = 'data/'
+DATA_CACHE = None # set to a dict to keep loaded data sets in memory across experiments
 
 if not os.path.exists(MODEL_PATH):
     os.makedirs(MODEL_PATH)
@@ -29,43 +35,36 @@ def load_attack_data():
     return train_x.astype('float32'), train_y.astype('int32'), test_x.astype('float32'), test_y.astype('int32')
 
 
-def train_target_model(args, dataset=None, epochs=100, batch_size=100, learning_rate=0.01, clipping_threshold=1, l2_ratio=1e-7, n_hidden=50, model='nn', privacy='no_privacy', dp='dp', epsilon=0.5, delta=1e-5, save=True):
-    if dataset == None:
-        dataset = load_data('target_data.npz', args)
-    train_x, train_y, test_x, test_y = dataset
-
-    classifier, aux = train_model(dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, clipping_threshold=clipping_threshold, batch_size=batch_size, model=model, l2_ratio=l2_ratio, silent=False, privacy=privacy, dp=dp, epsilon=epsilon, delta=delta)
-    # test data for attack model
+def get_attack_data(classifier, train_x, test_x):
     attack_x, attack_y = [], []
 
     # data used in training, label is 1
-    pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': train_x},
-        num_epochs=1,
-        shuffle=False)
-
-    predictions = classifier.predict(input_fn=pred_input_fn)
-    _, pred_scores = get_predictions(predictions)
+    _, pred_scores = models.predict(classifier, train_x)
 
     attack_x.append(pred_scores)
     attack_y.append(np.ones(train_x.shape[0]))
     
     # data not used in training, label is 0
-    pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': test_x},
-        num_epochs=1,
-        shuffle=False)
-
-    predictions = classifier.predict(input_fn=pred_input_fn)
-    _, pred_scores = get_predictions(predictions)
+    _, pred_scores = models.predict(classifier, test_x)
     
     attack_x.append(pred_scores)
     attack_y.append(np.zeros(test_x.shape[0]))
 
     attack_x = np.vstack(attack_x)
     attack_y = np.concatenate(attack_y)
-    attack_x = attack_x.astype('float32')
-    attack_y = attack_y.astype('int32')
+    return attack_x.astype('float32'), attack_y.astype('int32')
+
+
+def train_target_model(args, dataset=None, epochs=100, batch_size=100, learning_rate=0.01, clipping_threshold=1, l2_ratio=1e-7, n_hidden=50, model='nn', privacy='no_privacy', dp='dp', epsilon=0.5, delta=1e-5, dp_optimizer_impl='microbatch', save=True, model_dir=None, export_path=None, solver='adam', trajectory_epochs=None, trajectory_path=None, name='target'):
+    if dataset == None:
+        dataset = load_data('target_data.npz', args)
+    train_x, train_y, test_x, test_y = dataset
+
+    classifier, aux = models.train(dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, clipping_threshold=clipping_threshold, batch_size=batch_size, model=model, l2_ratio=l2_ratio, silent=False, privacy=privacy, dp=dp, epsilon=epsilon, delta=delta, dp_optimizer_impl=dp_optimizer_impl, model_dir=model_dir, solver=solver, trajectory_epochs=trajectory_epochs, trajectory_path=trajectory_path, name=name)
+    if export_path is not None:
+        models.export_model(classifier, export_path, aux)
+    # test data for attack model
+    attack_x, attack_y = get_attack_data(classifier, train_x, test_x)
 
     if save:
         np.savez(MODEL_PATH + 'attack_test_data.npz', attack_x, attack_y)
@@ -74,51 +73,40 @@ def train_target_model(args, dataset=None, epochs=100, batch_size=100, learning_
     return attack_x, attack_y, classes, classifier, aux
 
 
-def train_shadow_models(args, n_hidden=50, epochs=100, n_shadow=20, learning_rate=0.05, batch_size=100, l2_ratio=1e-7, model='nn', privacy='no_privacy', dp='dp', epsilon=0.5, delta=1e-5, save=True):
+def train_shadow_models(args, n_hidden=50, epochs=100, n_shadow=20, learning_rate=0.05, batch_size=100, l2_ratio=1e-7, model='nn', privacy='no_privacy', dp='dp', epsilon=0.5, delta=1e-5, save=True, export_dir=None, import_dir=None, top_k=0, stacked=False, solver='adam'):
+    # the shadow models are exported to export_dir, or loaded from import_dir instead of being trained;
+    # with top_k, only the top_k sorted scores of each shadow model are kept for attack training
     attack_x, attack_y = [], []
     classes = []
+    # shadow models fit by L-BFGS, like the target, are fit one by one, which takes seconds
+    stacked = stacked and not models.uses_lbfgs(solver, model, privacy)
+    if stacked and import_dir is None:
+        # all the shadow models are trained at once, as one stacked model
+        stacked_classifiers = models.train_stacked([load_data('shadow{}_data.npz'.format(i), args) for i in range(n_shadow)], n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, batch_size=batch_size, model=model, l2_ratio=l2_ratio)
     for i in range(n_shadow):
         #print('Training shadow model {}'.format(i))
         dataset = load_data('shadow{}_data.npz'.format(i), args)
         train_x, train_y, test_x, test_y = dataset
 
-        # train model
-        classifier = train_model(dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, batch_size=batch_size, model=model, l2_ratio=l2_ratio, privacy=privacy, dp=dp, epsilon=epsilon, delta=delta)
+        if import_dir is not None:
+            classifier, _ = models.load_model(import_dir + 'shadow{}.npz'.format(i))
+        else:
+            # train model
+            classifier = stacked_classifiers[i] if stacked else models.train(dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, batch_size=batch_size, model=model, l2_ratio=l2_ratio, privacy=privacy, dp=dp, epsilon=epsilon, delta=delta, solver=solver, name='shadow_%d' % i)
+            if export_dir is not None:
+                models.export_model(classifier, export_dir + 'shadow{}.npz'.format(i))
         #print('Gather training data for attack model')
-        attack_i_x, attack_i_y = [], []
-
-        # data used in training, label is 1
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': train_x},
-            num_epochs=1,
-            shuffle=False)
-
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, pred_scores = get_predictions(predictions)
-    
-        attack_i_x.append(pred_scores)
-        attack_i_y.append(np.ones(train_x.shape[0]))
-    
-        # data not used in training, label is 0
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': test_x},
-            num_epochs=1,
-            shuffle=False)
-
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, pred_scores = get_predictions(predictions)
-    
-        attack_i_x.append(pred_scores)
-        attack_i_y.append(np.zeros(test_x.shape[0]))
+        attack_i_x, attack_i_y = get_attack_data(classifier, train_x, test_x)
+        models.release_model(classifier)
+        if top_k:
+            attack_i_x = top_k_scores(attack_i_x, top_k)
         
-        attack_x += attack_i_x
-        attack_y += attack_i_y
+        attack_x.append(attack_i_x)
+        attack_y.append(attack_i_y)
         classes.append(np.concatenate([train_y, test_y]))
     # train data for attack model
     attack_x = np.vstack(attack_x)
     attack_y = np.concatenate(attack_y)
-    attack_x = attack_x.astype('float32')
-    attack_y = attack_y.astype('int32')
     classes = np.concatenate(classes)
 
     if save:
@@ -127,7 +115,45 @@ def train_shadow_models(args, n_hidden=50, epochs=100, n_shadow=20, learning_rat
     return attack_x, attack_y, classes
 
 
-def train_attack_model(classes, dataset=None, n_hidden=50, learning_rate=0.01, batch_size=200, epochs=50, model='nn', l2_ratio=1e-7):
+def attack_features(x, model):
+    # the threshold attack only uses the confidence of the top prediction
+    x = np.max(x, axis=1, keepdims=True) if model == 'threshold' else x
+    return np.hstack([x.astype(np.float64), np.ones((len(x), 1))])
+
+
+def fit_numpy_attack_models(x, y, classes, unique_classes, model='softmax', l2_ratio=1e-7, max_iter=500):
+    # Fits one logistic attack model per class, with the same per-class objective as the
+    # 'softmax' estimator (mean cross entropy plus l2_ratio * squared weights). The classes are
+    # independent, so their summed objective is minimized jointly by a single L-BFGS run.
+    # 'nn' has no numpy counterpart and falls back to the logistic model.
+    features = attack_features(x, model)
+    idx = np.searchsorted(unique_classes, classes)
+    one_hot = sparse.csr_matrix((np.ones(len(idx)), (np.arange(len(idx)), idx)), shape=(len(idx), len(unique_classes)))
+    weights = 1. / np.bincount(idx, minlength=len(unique_classes))[idx]
+    n_classes, n_features = len(unique_classes), features.shape[1]
+
+    def objective(w):
+        W = w.reshape(n_classes, n_features)
+        z = np.einsum('ij,ij->i', features, W[idx])
+        loss = np.sum(weights * (np.logaddexp(0, z) - y * z)) + l2_ratio * np.sum(W[:, :-1]**2)
+        grad = one_hot.T @ ((weights * (special.expit(z) - y))[:, np.newaxis] * features)
+        grad[:, :-1] += 2 * l2_ratio * W[:, :-1]
+        return loss, grad.ravel()
+
+    result = optimize.minimize(objective, np.zeros(n_classes * n_features), jac=True, method='L-BFGS-B', options={'maxiter': max_iter})
+    return result.x.reshape(n_classes, n_features)
+
+
+def numpy_attack_scores(W, x, classes, unique_classes, model='softmax'):
+    # membership scores in the same [non-member, member] layout as the estimator predictions
+    z = np.einsum('ij,ij->i', attack_features(x, model), W[np.searchsorted(unique_classes, classes)])
+    member = special.expit(z)
+    return np.stack([1 - member, member], axis=1).astype('float32')
+
+
+def train_attack_model(classes, dataset=None, n_hidden=50, learning_rate=0.01, batch_size=200, epochs=50, model='nn', l2_ratio=1e-7, backend='tf'):
+    if backend not in ['tf', 'numpy']:
+        raise ValueError('unknown attack backend %s, choose tf or numpy' % backend)
     if dataset is None:
         dataset = load_attack_data()
     train_x, train_y, test_x, test_y = dataset
@@ -137,54 +163,70 @@ def train_attack_model(classes, dataset=None, n_hidden=50, learning_rate=0.01, b
     test_indices = np.arange(len(test_x))
     unique_classes = np.unique(train_classes)
 
-    pred_y = []
-    shadow_membership, target_membership = [], []
-    shadow_pred_scores, target_pred_scores = [], []
-    shadow_class_labels, target_class_labels = [], []
-    for c in unique_classes:
-        #print('Training attack model for class {}...'.format(c))
-        c_train_indices = train_indices[train_classes == c]
-        c_train_x, c_train_y = train_x[c_train_indices], train_y[c_train_indices]
-        c_test_indices = test_indices[test_classes == c]
-        c_test_x, c_test_y = test_x[c_test_indices], test_y[c_test_indices]
-        c_dataset = (c_train_x, c_train_y, c_test_x, c_test_y)
-        classifier = train_model(c_dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, batch_size=batch_size, model=model, l2_ratio=l2_ratio)
+    if backend == 'numpy':
+        # all per-class attack models are fit together in numpy, without building any TF graph
+        W = fit_numpy_attack_models(train_x, train_y, train_classes, unique_classes, model=model, l2_ratio=l2_ratio)
+        # same record order as the per-class models below: grouped by class in ascending order,
+        # skipping test records of classes that have no attack model
+        c_test_indices = test_indices[np.isin(test_classes, unique_classes)]
+        train_order = np.argsort(train_classes, kind='stable')
+        test_order = c_test_indices[np.argsort(test_classes[c_test_indices], kind='stable')]
+        shadow_pred_scores = numpy_attack_scores(W, train_x[train_order], train_classes[train_order], unique_classes, model=model)
+        target_pred_scores = numpy_attack_scores(W, test_x[test_order], test_classes[test_order], unique_classes, model=model)
+        pred_y = np.argmax(target_pred_scores, axis=1)
+        shadow_membership, target_membership = train_y[train_order], test_y[test_order]
+        shadow_class_labels, target_class_labels = train_classes[train_order], test_classes[test_order]
+    else:
+        pred_y = []
+        shadow_membership, target_membership = [], []
+        shadow_pred_scores, target_pred_scores = [], []
+        shadow_class_labels, target_class_labels = [], []
+        for c in unique_classes:
+            #print('Training attack model for class {}...'.format(c))
+            c_train_indices = train_indices[train_classes == c]
+            # compact scores are stored in half precision
+            c_train_x, c_train_y = train_x[c_train_indices].astype('float32', copy=False), train_y[c_train_indices]
+            c_test_indices = test_indices[test_classes == c]
+            c_test_x, c_test_y = test_x[c_test_indices].astype('float32', copy=False), test_y[c_test_indices]
+            c_dataset = (c_train_x, c_train_y, c_test_x, c_test_y)
+            classifier = models.train(c_dataset, n_hidden=n_hidden, epochs=epochs, learning_rate=learning_rate, batch_size=batch_size, model=model, l2_ratio=l2_ratio, name='attack_%d' % c)
         
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': c_train_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        c_pred_y, c_pred_scores = get_predictions(predictions)
-        shadow_membership.append(c_train_y)
-        shadow_pred_scores.append(c_pred_scores)
-        shadow_class_labels.append([c]*len(c_train_indices))
-
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': c_test_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        c_pred_y, c_pred_scores = get_predictions(predictions)
-        pred_y.append(c_pred_y)
-        target_membership.append(c_test_y)
-        target_pred_scores.append(c_pred_scores)
-        target_class_labels.append([c]*len(c_test_indices))
+            c_pred_y, c_pred_scores = models.predict(classifier, c_train_x)
+            shadow_membership.append(c_train_y)
+            shadow_pred_scores.append(c_pred_scores)
+            shadow_class_labels.append([c]*len(c_train_indices))
+
+            c_pred_y, c_pred_scores = models.predict(classifier, c_test_x)
+            pred_y.append(c_pred_y)
+            target_membership.append(c_test_y)
+            target_pred_scores.append(c_pred_scores)
+            target_class_labels.append([c]*len(c_test_indices))
+            models.release_model(classifier)
+
+        pred_y = np.concatenate(pred_y)
+        shadow_membership = np.concatenate(shadow_membership)
+        target_membership = np.concatenate(target_membership)
+        shadow_pred_scores = np.concatenate(shadow_pred_scores)
+        target_pred_scores = np.concatenate(target_pred_scores)
+        shadow_class_labels = np.concatenate(shadow_class_labels)
+        target_class_labels = np.concatenate(target_class_labels)
 
     print('-' * 10 + 'FINAL EVALUATION' + '-' * 10 + '\n')
-    pred_y = np.concatenate(pred_y)
-    shadow_membership = np.concatenate(shadow_membership)
-    target_membership = np.concatenate(target_membership)
-    shadow_pred_scores = np.concatenate(shadow_pred_scores)
-    target_pred_scores = np.concatenate(target_pred_scores)
-    shadow_class_labels = np.concatenate(shadow_class_labels)
-    target_class_labels = np.concatenate(target_class_labels)
     prety_print_result(target_membership, pred_y)
-    fpr, tpr, thresholds = roc_curve(target_membership, pred_y, pos_label=1)
+    fpr, tpr, thresholds = metrics.roc_curve(target_membership, pred_y, pos_label=1)
     attack_adv = tpr[1] - fpr[1]
     return (attack_adv, shadow_pred_scores, target_pred_scores, shadow_membership, target_membership, shadow_class_labels, target_class_labels)
 
 
+def compact_attack_outputs(outputs):
+    # half precision scores and the narrowest integer types for the memberships and class labels
+    attack_adv, shadow_pred_scores, target_pred_scores, shadow_membership, target_membership, shadow_class_labels, target_class_labels = outputs
+    label_type = np.min_scalar_type(max(np.max(shadow_class_labels), np.max(target_class_labels, initial=0)))
+    return (attack_adv, shadow_pred_scores.astype(np.float16), target_pred_scores.astype(np.float16),
+        shadow_membership.astype(np.uint8), target_membership.astype(np.uint8),
+        shadow_class_labels.astype(label_type), target_class_labels.astype(label_type))
+
+
 def save_data(args):
     print('-' * 10 + 'SAVING DATA TO DISK' + '-' * 10 + '\n')
 
@@ -199,9 +241,9 @@ def save_data(args):
 
     # assert if data is enough for sampling target data
     assert(len(x) >= (1 + gamma) * target_size)
-    x, train_x, y, train_y = train_test_split(x, y, test_size=target_size, stratify=y)
+    x, train_x, y, train_y = model_selection.train_test_split(x, y, test_size=target_size, stratify=y)
     print("Training set size:  X: {}, y: {}".format(train_x.shape, train_y.shape))
-    x, test_x, y, test_y = train_test_split(x, y, test_size=int(gamma*target_size), stratify=y)
+    x, test_x, y, test_y = model_selection.train_test_split(x, y, test_size=int(gamma*target_size), stratify=y)
     print("Test set size:  X: {}, y: {}".format(test_x.shape, test_y.shape))
 
     # save target data
@@ -214,7 +256,7 @@ def save_data(args):
     # save shadow data
     for i in range(args.n_shadow):
         print('Saving data for shadow model {}'.format(i))
-        train_x, test_x, train_y, test_y = train_test_split(x, y, train_size=target_size, test_size=int(gamma*target_size), stratify=y)
+        train_x, test_x, train_y, test_y = model_selection.train_test_split(x, y, train_size=target_size, test_size=int(gamma*target_size), stratify=y)
         print("Training set size:  X: {}, y: {}".format(train_x.shape, train_y.shape))
         print("Test set size:  X: {}, y: {}".format(test_x.shape, test_y.shape))
         np.savez(DATA_PATH + 'shadow{}_data.npz'.format(i), train_x, train_y, test_x, test_y)
@@ -223,43 +265,63 @@ def save_data(args):
 def load_data(data_name, args):
     target_size = args.target_data_size
     gamma = args.target_test_train_ratio
-    with np.load(DATA_PATH + data_name) as f:
-        train_x, train_y, test_x, test_y = [f['arr_%d' % i] for i in range(len(f.files))]
+    if DATA_CACHE is not None and DATA_PATH + data_name in DATA_CACHE:
+        train_x, train_y, test_x, test_y = DATA_CACHE[DATA_PATH + data_name]
+    else:
+        with np.load(DATA_PATH + data_name) as f:
+            train_x, train_y, test_x, test_y = [f['arr_%d' % i] for i in range(len(f.files))]
 
-    train_x = np.array(train_x, dtype=np.float32)
-    test_x = np.array(test_x, dtype=np.float32)
+        train_x = np.array(train_x, dtype=np.float32)
+        test_x = np.array(test_x, dtype=np.float32)
 
-    train_y = np.array(train_y, dtype=np.int32)
-    test_y = np.array(test_y, dtype=np.int32)
+        train_y = np.array(train_y, dtype=np.int32)
+        test_y = np.array(test_y, dtype=np.int32)
+
+        if DATA_CACHE is not None:
+            # cached arrays are shared by all experiments, so they must not be modified in place
+            for a in (train_x, train_y, test_x, test_y):
+                a.setflags(write=False)
+            DATA_CACHE[DATA_PATH + data_name] = (train_x, train_y, test_x, test_y)
 
     return train_x, train_y, test_x[:int(gamma*target_size)], test_y[:int(gamma*target_size)]
 
 
-def shokri_membership_inference(args, attack_test_x, attack_test_y, test_classes):
+def shokri_membership_inference(args, attack_test_x, attack_test_y, test_classes, export_dir=None, import_dir=None):
     print('-' * 10 + 'SHOKRI\'S MEMBERSHIP INFERENCE' + '-' * 10 + '\n')    
     print('-' * 10 + 'TRAIN SHADOW' + '-' * 10 + '\n')
-    attack_train_x, attack_train_y, train_classes = train_shadow_models(
-        args=args,
-        epochs=args.target_epochs,
-        batch_size=args.target_batch_size,
-        learning_rate=args.target_learning_rate,
-        n_shadow=args.n_shadow,
-        n_hidden=args.target_n_hidden,
-        l2_ratio=args.target_l2_ratio,
-        model=args.target_model,
-        save=args.save_model)
+    with profile_phase('shadow_training', args.n_shadow * args.target_data_size * args.target_epochs):
+        attack_train_x, attack_train_y, train_classes = train_shadow_models(
+            args=args,
+            epochs=args.target_epochs,
+            batch_size=args.target_batch_size,
+            learning_rate=args.target_learning_rate,
+            n_shadow=args.n_shadow,
+            n_hidden=args.target_n_hidden,
+            l2_ratio=args.target_l2_ratio,
+            model=args.target_model,
+            save=args.save_model,
+            export_dir=export_dir,
+            import_dir=import_dir,
+            top_k=args.compact_scores,
+            stacked=args.stacked_shadow,
+            solver=args.target_solver)
 
     print('-' * 10 + 'TRAIN ATTACK' + '-' * 10 + '\n')
+    if args.compact_scores:
+        attack_test_x = top_k_scores(attack_test_x, args.compact_scores)
     dataset = (attack_train_x, attack_train_y, attack_test_x, attack_test_y)
-    return train_attack_model(
-        dataset=dataset,
-        epochs=args.attack_epochs,
-        batch_size=args.attack_batch_size,
-        learning_rate=args.attack_learning_rate,
-        n_hidden=args.attack_n_hidden,
-        l2_ratio=args.attack_l2_ratio,
-        model=args.attack_model,
-        classes=(train_classes, test_classes))
+    with profile_phase('attack_training', len(attack_train_x) * args.attack_epochs):
+        outputs = train_attack_model(
+            dataset=dataset,
+            epochs=args.attack_epochs,
+            batch_size=args.attack_batch_size,
+            learning_rate=args.attack_learning_rate,
+            n_hidden=args.attack_n_hidden,
+            l2_ratio=args.attack_l2_ratio,
+            model=args.attack_model,
+            classes=(train_classes, test_classes),
+            backend=args.attack_backend)
+    return compact_attack_outputs(outputs) if args.compact_scores else outputs
 
 
 def yeom_membership_inference(per_instance_loss, membership, train_loss, test_loss=None):
@@ -272,30 +334,94 @@ def yeom_membership_inference(per_instance_loss, membership, train_loss, test_lo
     return pred_membership
 
 
-def proposed_membership_inference(v_dataset, true_x, true_y, classifier, per_instance_loss, args):
-    print('-' * 10 + 'PROPOSED MEMBERSHIP INFERENCE' + '-' * 10 + '\n')
+def reference_model_name(i):
+    return 'reference.npz' if i == 0 else 'reference{}.npz'.format(i)
+
+
+def get_reference_model(v_dataset, args, name, export_dir=None, import_dir=None, profile=True):
+    # a reference model exported to import_dir is loaded instead of being trained
     v_train_x, v_train_y, v_test_x, v_test_y = v_dataset
-    v_true_x = np.vstack([v_train_x, v_test_x])
-    v_true_y = np.concatenate([v_train_y, v_test_y])    
-    v_pred_y, v_membership, v_test_classes, v_classifier, aux = train_target_model(
-        args=args,
-        dataset=v_dataset,
-        epochs=args.target_epochs,
-        batch_size=args.target_batch_size,
-        learning_rate=args.target_learning_rate,
-        clipping_threshold=args.target_clipping_threshold,
-        n_hidden=args.target_n_hidden,
-        l2_ratio=args.target_l2_ratio,
-        model=args.target_model,
-        privacy=args.target_privacy,
-        dp=args.target_dp,
-        epsilon=args.target_epsilon,
-        delta=args.target_delta,
-        save=args.save_model)
-    v_per_instance_loss = np.array(log_loss(v_true_y, v_pred_y))
+    if import_dir is not None and is_resumable_model(import_dir, name):
+        v_classifier, _ = models.load_model(import_dir + name)
+        v_pred_y, v_membership = get_attack_data(v_classifier, v_train_x, v_test_x)
+        return v_classifier, v_pred_y, v_membership
+    with profile_phase('reference_training', len(v_train_x) * args.target_epochs, enabled=profile):
+        v_pred_y, v_membership, v_test_classes, v_classifier, aux = train_target_model(
+            args=args,
+            dataset=v_dataset,
+            epochs=args.target_epochs,
+            batch_size=args.target_batch_size,
+            learning_rate=args.target_learning_rate,
+            clipping_threshold=args.target_clipping_threshold,
+            n_hidden=args.target_n_hidden,
+            l2_ratio=args.target_l2_ratio,
+            model=args.target_model,
+            privacy=args.target_privacy,
+            dp=args.target_dp,
+            epsilon=args.target_epsilon,
+            delta=args.target_delta,
+            dp_optimizer_impl=args.target_dp_optimizer,
+            save=args.save_model and name == reference_model_name(0),
+            solver=args.target_solver,
+            export_path=export_dir + name if export_dir is not None else None,
+            name=os.path.splitext(name)[0])
+    return v_classifier, v_pred_y, v_membership
+
+
+def report_reference_thresholds(reference_outputs, fpr_threshold=0.01):
+    # spread of the thresholds that each reference model alone would give, at the FPR the drivers evaluate
+    print('-' * 10 + 'REFERENCE MODEL THRESHOLDS' + '-' * 10 + '\n')
+    loss_threshs, count_threshs = [], []
+    for i, (v_true_y, v_membership, v_per_instance_loss, v_counts) in enumerate(reference_outputs):
+        loss_threshs.append(-get_inference_threshold(-v_per_instance_loss, v_membership, fpr_threshold))
+        count_threshs.append(get_inference_threshold(v_counts, v_membership, fpr_threshold))
+        print('Reference %d: loss threshold %.6f, Merlin threshold %g' % (i, loss_threshs[-1], count_threshs[-1]))
+    for name, threshs in [('Loss', loss_threshs), ('Merlin', count_threshs)]:
+        # a reference model with no threshold below the FPR gives an infinite one, which is left out
+        threshs = np.array(threshs)
+        finite = threshs[np.isfinite(threshs)]
+        if len(finite) == 0:
+            print('%s threshold: no reference model reaches the FPR' % name)
+            continue
+        print('%s threshold: mean %.6f, std %.6f, min %.6f, max %.6f (%d of %d references infinite)' % (name, np.mean(finite), np.std(finite), np.min(finite), np.max(finite), len(threshs) - len(finite), len(threshs)))
+
+
+def proposed_membership_inference(v_dataset, true_x, true_y, classifier, per_instance_loss, args, export_dir=None, import_dir=None):
+    # Reference model i is trained on the shadow{i} split, v_dataset being shadow0. With several
+    # reference models, they are trained and queried concurrently, and their losses and Merlin
+    # counts are pooled for threshold selection.
+    print('-' * 10 + 'PROPOSED MEMBERSHIP INFERENCE' + '-' * 10 + '\n')
+    if args.n_reference > args.n_shadow:
+        raise ValueError('%d reference models need as many shadow splits, but --n_shadow is %d' % (args.n_reference, args.n_shadow))
     noise_params = (args.attack_noise_type, args.attack_noise_coverage, args.attack_noise_magnitude)
-    v_counts = loss_increase_counts(v_true_x, v_true_y, v_classifier, v_per_instance_loss, noise_params)
-    counts = loss_increase_counts(true_x, true_y, classifier, per_instance_loss, noise_params)
+    # the reference and target records are perturbed with the same noise
+    noise_bank = get_noise_bank(noise_params, (len(v_dataset[0]) + len(v_dataset[2]), v_dataset[0].shape[1])) if args.attack_noise_bank else None
+
+    # the reference models run concurrently as one profiled phase, since the CPU time of each
+    # phase covers all the threads of the process
+    pooled = args.n_reference > 1
+
+    def reference_outputs(i):
+        v_dataset_i = v_dataset if i == 0 else load_data('shadow{}_data.npz'.format(i), args)
+        v_train_x, v_train_y, v_test_x, v_test_y = v_dataset_i
+        v_true_x = np.vstack([v_train_x, v_test_x])
+        v_true_y = np.concatenate([v_train_y, v_test_y])
+        v_classifier, v_pred_y, v_membership = get_reference_model(v_dataset_i, args, reference_model_name(i), export_dir=export_dir, import_dir=import_dir, profile=not pooled)
+        v_per_instance_loss = np.array(log_loss(v_true_y, v_pred_y))
+        # every count query perturbs and scores each record once per trial
+        with profile_phase('merlin_counts', len(v_true_x) * 100, enabled=not pooled):
+            v_counts = loss_increase_counts(v_true_x, v_true_y, v_classifier, v_per_instance_loss, noise_params, noise_bank=noise_bank)
+        return v_true_y, v_membership, v_per_instance_loss, v_counts
+
+    if not pooled:
+        references = [reference_outputs(0)]
+    else:
+        with profile_phase('reference_models', args.n_reference * len(v_dataset[0]) * args.target_epochs), ThreadPool(args.n_reference) as pool:
+            references = pool.map(reference_outputs, range(args.n_reference))
+        report_reference_thresholds(references)
+    v_true_y, v_membership, v_per_instance_loss, v_counts = [np.concatenate(a) for a in zip(*references)]
+    with profile_phase('merlin_counts', len(true_x) * 100):
+        counts = loss_increase_counts(true_x, true_y, classifier, per_instance_loss, noise_params, noise_bank=noise_bank)
     return (true_y, v_true_y, v_membership, v_per_instance_loss, v_counts, counts)
 
 
@@ -330,16 +456,20 @@ def evaluate_proposed_membership_inference(per_instance_loss, membership, propos
     prety_print_result(membership, pred_membership)
 
 
-def loss_increase_counts(true_x, true_y, classifier, per_instance_loss, noise_params, max_t=100):
+def get_noise_bank(noise_params, shape, trials=100, seed=SEED):
+    # one bank per noise configuration and data shape, shared by all experiments on the same data
+    path = DATA_PATH + 'noise_bank_%s_%s_%s_%dx%d_%d_%d.npy' % (noise_params + shape + (trials, seed))
+    return create_noise_bank(path, shape, noise_params, trials, seed=seed)
+
+
+def loss_increase_counts(true_x, true_y, classifier, per_instance_loss, noise_params, max_t=100, noise_bank=None):
     counts = np.zeros(len(true_x))
     for t in range(max_t):
-        noisy_x = true_x + generate_noise(true_x.shape, true_x.dtype, noise_params)
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': noisy_x}, 
-           num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, pred_y = get_predictions(predictions)
+        if noise_bank is None:
+            noisy_x = true_x + generate_noise(true_x.shape, true_x.dtype, noise_params)
+        else:
+            noisy_x = add_noise(true_x, noise_bank, t)
+        _, pred_y = models.predict(classifier, noisy_x)
         noisy_per_instance_loss = np.array(log_loss(true_y, pred_y))
         counts += np.where(noisy_per_instance_loss > per_instance_loss, 1, 0)
     return counts
@@ -353,22 +483,12 @@ def yeom_attribute_inference(true_x, true_y, classifier, membership, features, t
         low_value, high_value, true_attribute_value = get_attribute_variations(true_x, feature)
         
         true_x[:,feature] = low_value
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': true_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, low_op = get_predictions(predictions)
+        _, low_op = models.predict(classifier, true_x)
         low_op = low_op.astype('float32')
         low_op = log_loss(true_y, low_op)
         
         true_x[:,feature] = high_value
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': true_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, high_op = get_predictions(predictions)
+        _, high_op = models.predict(classifier, true_x)
         high_op = high_op.astype('float32')
         high_op = log_loss(true_y, high_op)
         
@@ -396,32 +516,23 @@ def proposed_attribute_inference(true_x, true_y, classifier, membership, feature
     low_per_instance_loss_all, high_per_instance_loss_all = [], []
     low_counts_all, high_counts_all = [], []
     true_attribute_value_all = []
+    noise_params = (args.attack_noise_type, args.attack_noise_coverage, args.attack_noise_magnitude)
+    noise_bank = get_noise_bank(noise_params, true_x.shape) if args.attack_noise_bank else None
     for feature in features:
         orignial_attribute = np.copy(true_x[:,feature])
         low_value, high_value, true_attribute_value = get_attribute_variations(true_x, feature)
-        noise_params = (args.attack_noise_type, args.attack_noise_coverage, args.attack_noise_magnitude)
         
         true_x[:,feature] = low_value
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': true_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, low_op = get_predictions(predictions)
+        _, low_op = models.predict(classifier, true_x)
         low_op = low_op.astype('float32')
         low_op = log_loss(true_y, low_op)
-        low_counts = loss_increase_counts(true_x, true_y, classifier, low_op, noise_params)
+        low_counts = loss_increase_counts(true_x, true_y, classifier, low_op, noise_params, noise_bank=noise_bank)
         
         true_x[:,feature] = high_value
-        pred_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-            x={'x': true_x},
-            num_epochs=1,
-            shuffle=False)
-        predictions = classifier.predict(input_fn=pred_input_fn)
-        _, high_op = get_predictions(predictions)
+        _, high_op = models.predict(classifier, true_x)
         high_op = high_op.astype('float32')
         high_op = log_loss(true_y, high_op)
-        high_counts = loss_increase_counts(true_x, true_y, classifier, high_op, noise_params)
+        high_counts = loss_increase_counts(true_x, true_y, classifier, high_op, noise_params, noise_bank=noise_bank)
         
         true_attribute_value_all.append(true_attribute_value)
         low_per_instance_loss_all.append(low_op)
@@ -0,0 +1,154 @@
+import attack
+import evaluating_dpml
+import improved_mi
+from attack import loss_increase_counts
+from classifier import train, train_stacked, predict, release_model, model_storage, configure_threads
+from utilities import log_loss, get_inference_threshold, create_noise_bank
+from generate_synthetic_data import make_synthetic_dataset
+import numpy as np
+import contextlib
+import argparse
+import tempfile
+import platform
+import shutil
+import json
+import time
+import sys
+import io
+import os
+
+# target data size, number of features and number of classes of each scale
+SCALES = {
+    'small': (500, 20, 5),
+    'medium': (2000, 100, 20),
+    'large': (10000, 600, 100),
+}
+N_SHADOW = 2
+
+
+def write_splits(data_path, target_size, n_features, n_classes, seed):
+    # same files as attack.save_data, without requiring a pickled data set
+    x, y = make_synthetic_dataset(2 * target_size * (1 + N_SHADOW), n_features, n_classes, seed=seed)
+    for i, name in enumerate(['target_data.npz'] + ['shadow{}_data.npz'.format(j) for j in range(N_SHADOW)]):
+        offset = 2 * i * target_size
+        np.savez(data_path + name, x[offset:offset + target_size], y[offset:offset + target_size], x[offset + target_size:offset + 2 * target_size], y[offset + target_size:offset + 2 * target_size])
+
+
+def time_it(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        # the hot paths print progress, which is not part of what is measured
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeats': repeats}
+
+
+def run_scale(scale, args):
+    target_size, n_features, n_classes = SCALES[scale]
+    work_dir = tempfile.mkdtemp(prefix='dpml_benchmark_')
+    # the drivers read their data and write their results relative to these paths
+    attack.DATA_PATH = work_dir + '/data/'
+    evaluating_dpml.RESULT_PATH = improved_mi.RESULT_PATH = work_dir + '/results/'
+    os.makedirs(attack.DATA_PATH)
+    try:
+        write_splits(attack.DATA_PATH, target_size, n_features, n_classes, args.seed)
+        with np.load(attack.DATA_PATH + 'target_data.npz') as f:
+            train_x, train_y, test_x, test_y = [f['arr_%d' % i] for i in range(len(f.files))]
+        dataset = (train_x, train_y, test_x, test_y)
+        true_x = np.vstack((train_x, test_x))
+        true_y = np.append(train_y, test_y)
+        results = {}
+
+        # micro benchmarks of the hot paths
+        rng = np.random.RandomState(args.seed)
+        scores = rng.dirichlet(np.ones(n_classes), size=len(true_y)).astype(np.float32)
+        membership = np.append(np.ones(len(train_y)), np.zeros(len(test_y)))
+        loss = np.array(log_loss(true_y, scores))
+        results['log_loss'] = time_it(lambda: log_loss(true_y, scores), args.repeats)
+        results['get_inference_threshold'] = time_it(lambda: get_inference_threshold(-loss, membership), args.repeats)
+        results['get_inference_threshold_fpr'] = time_it(lambda: get_inference_threshold(-loss, membership, fpr_threshold=0.01), args.repeats)
+
+        for model in ['softmax', 'nn']:
+            results['train_' + model] = time_it(lambda: release_model(train(dataset, model=model, epochs=args.epochs, batch_size=100, n_hidden=64)), args.repeats)
+        # the shadow models of an experiment, one after the other or stacked in one graph
+        results['train_shadow_serial'] = time_it(lambda: [release_model(train(dataset, model='nn', epochs=args.epochs, batch_size=100, n_hidden=64)) for _ in range(N_SHADOW)], args.repeats)
+        results['train_shadow_stacked'] = time_it(lambda: [release_model(m) for m in train_stacked([dataset] * N_SHADOW, model='nn', epochs=args.epochs, batch_size=100, n_hidden=64)], args.repeats)
+        model = train(dataset, model='nn', epochs=args.epochs, batch_size=100, n_hidden=64)
+        results['predict'] = time_it(lambda: predict(model, true_x), args.repeats)
+        per_instance_loss = np.array(log_loss(true_y, predict(model, true_x)[1]))
+        noise_params = ('gaussian', 'full', 0.01)
+        results['loss_increase_counts'] = time_it(lambda: loss_increase_counts(true_x, true_y, model, per_instance_loss, noise_params, max_t=args.noise_trials), args.repeats)
+        noise_bank = create_noise_bank(work_dir + '/noise_bank.npy', true_x.shape, noise_params, args.noise_trials, seed=args.seed)
+        results['loss_increase_counts_noise_bank'] = time_it(lambda: loss_increase_counts(true_x, true_y, model, per_instance_loss, noise_params, max_t=args.noise_trials, noise_bank=noise_bank), args.repeats)
+        release_model(model)
+
+        # macro benchmarks of the end-to-end experiments
+        if args.macro:
+            for driver in [evaluating_dpml, improved_mi]:
+                driver_args = driver.get_parser().parse_args([
+                    'benchmark',
+                    '--target_data_size=%d' % target_size,
+                    '--n_shadow=%d' % N_SHADOW,
+                    '--target_epochs=%d' % args.epochs,
+                    '--attack_epochs=%d' % args.epochs])
+                results['run_experiment_' + driver.__name__] = time_it(lambda: driver.run_experiment(driver_args), 1)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    # a benchmark regresses if its best time is more than tolerance slower than the baseline's
+    regressions = 0
+    for scale in results['scales']:
+        for name, timing in results['scales'][scale].items():
+            if name not in baseline['scales'].get(scale, {}):
+                continue
+            ratio = timing['min'] / baseline['scales'][scale][name]['min']
+            flag = 'REGRESSION' if ratio > 1 + tolerance else ('improved' if ratio < 1 - tolerance else '')
+            regressions += flag == 'REGRESSION'
+            print('%-8s %-36s %10.4fs  %10.4fs  %6.2fx  %s' % (scale, name, baseline['scales'][scale][name]['min'], timing['min'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=str, nargs='+', default=['small'], choices=list(SCALES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--noise_trials', type=int, default=10)
+    parser.add_argument('--macro', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    print(vars(args))
+
+    configure_threads(args.intra_op_threads, args.inter_op_threads)
+    results = {
+        'config': vars(args),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': len(os.sched_getaffinity(0))},
+        'scales': {}}
+    with model_storage():
+        for scale in args.scales:
+            print('-' * 10 + 'BENCHMARK %s %s' % (scale.upper(), SCALES[scale]) + '-' * 10)
+            results['scales'][scale] = run_scale(scale, args)
+            for name, timing in results['scales'][scale].items():
+                print('%-36s min %10.4fs  median %10.4fs' % (name, timing['min'], timing['median']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('-' * 10 + 'COMPARISON WITH ' + args.compare + '-' * 10)
+        regressions = compare(results, baseline, args.tolerance)
+        print('%d regressions beyond %.0f%% tolerance' % (regressions, 100 * args.tolerance))
+        sys.exit(1 if regressions else 0)
@@ -3,51 +3,270 @@ from tensorflow_privacy.privacy.analysis.rdp_accountant import compute_rdp
 from tensorflow_privacy.privacy.analysis.rdp_accountant import get_privacy_spent
 from tensorflow_privacy.privacy.optimizers import dp_optimizer
 from constants import rdp_noise_multiplier, gdp_noise_multiplier
+from scipy import optimize, special
 import tensorflow as tf
 import numpy as np
+import contextlib
+import tempfile
+import signal
+import atexit
+import shutil
+import json
 import os
 
 LOGGING = False # enables tf.train.ProfilerHook (see use below)
 LOG_DIR = 'log'
+SCRATCH_DIR = '/dev/shm' # tmpfs holding the checkpoints of transient models, falls back to the system temp dir
+EVAL_BATCH_SIZE = 1000 # batch size of the evaluation and prediction passes
+SESSION_CONFIG = None # session config (thread pools) of every model and predictor, see configure_threads()
+LBFGS_MAX_ITER = 500 # iterations of the full-batch solver of the non-private softmax model
+TRAJECTORY_COLLECTION = 'trajectory_loss' # graph collection of the per-example loss recorded by _TrajectoryHook
 
 AdamOptimizer = tf.compat.v1.train.AdamOptimizer
 
-def get_predictions(predictions):
+_model_storage = None
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+    # 0 leaves the choice to TensorFlow, which sizes both pools to all cores of the node
+    global SESSION_CONFIG
+    SESSION_CONFIG = tf.compat.v1.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+
+
+def get_model_storage():
+    # every model that is not explicitly saved lives in a sub-directory of this
+    # per-process directory, which is removed by release_model_storage()
+    global _model_storage
+    if _model_storage is None:
+        root = SCRATCH_DIR if os.path.isdir(SCRATCH_DIR) and os.access(SCRATCH_DIR, os.W_OK) else None
+        _model_storage = tempfile.mkdtemp(prefix='dpml_models_', dir=root)
+    return _model_storage
+
+
+def release_model_storage():
+    global _model_storage
+    if _model_storage is not None:
+        shutil.rmtree(_model_storage, ignore_errors=True)
+        _model_storage = None
+
+atexit.register(release_model_storage)
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+@contextlib.contextmanager
+def model_storage():
+    # removes all transient models when the experiment finishes or fails,
+    # including when the process is terminated with SIGTERM
+    previous_handler = signal.signal(signal.SIGTERM, _raise_system_exit)
+    try:
+        yield get_model_storage()
+    finally:
+        release_model_storage()
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+def release_model(classifier):
+    # deletes the checkpoints of a transient model that is no longer needed
+    if _model_storage is not None and os.path.dirname(os.path.normpath(classifier.model_dir)) == _model_storage:
+        shutil.rmtree(classifier.model_dir, ignore_errors=True)
+
+class _FeedArraysHook(tf.estimator.SessionRunHook):
+    # loads the in-memory arrays into the input pipeline once per session
+    def __init__(self):
+        self.initializer = None
+        self.feed_dict = None
+
+    def after_create_session(self, session, coord):
+        session.run(self.initializer, feed_dict=self.feed_dict)
+
+
+class _TrajectoryHook(tf.estimator.SessionRunHook):
+    # At the end of each recorded epoch, scores the training and held-out records with the
+    # weights being trained, within the training session itself, and writes their per-example
+    # losses to the epoch's row of trajectory. The epochs are counted from the global step, so
+    # that they carry on across the training calls of one model.
+    def __init__(self, x, y, steps_per_epoch, epochs, trajectory):
+        self.x, self.y = x, y
+        self.steps_per_epoch = steps_per_epoch
+        self.rows = {epoch: row for row, epoch in enumerate(epochs)}
+        self.trajectory = trajectory
+
+    def begin(self):
+        self.global_step = tf.compat.v1.train.get_global_step()
+        self.x_ph, self.y_ph, self.loss = tf.compat.v1.get_collection(TRAJECTORY_COLLECTION)
+
+    def after_create_session(self, session, coord):
+        self.step = session.run(self.global_step)
+
+    def after_run(self, run_context, run_values):
+        self.step += 1
+        epoch, remainder = divmod(self.step, self.steps_per_epoch)
+        if remainder or epoch not in self.rows:
+            return
+        for start in range(0, len(self.x), EVAL_BATCH_SIZE):
+            feed_dict = {self.x_ph: self.x[start:start + EVAL_BATCH_SIZE], self.y_ph: self.y[start:start + EVAL_BATCH_SIZE]}
+            self.trajectory[self.rows[epoch], start:start + EVAL_BATCH_SIZE] = run_context.session.run(self.loss, feed_dict=feed_dict)
+
+
+def get_input_fn(x, y=None, batch_size=EVAL_BATCH_SIZE, shuffle=False):
+    # tf.data pipeline over in-memory arrays. The arrays are fed once per session
+    # (rather than embedded as constants in every checkpointed graph) and each batch
+    # is gathered from them with a single vectorized op. When shuffling, the data
+    # is reshuffled and repeated indefinitely, so one pipeline serves all epochs.
+    # The returned hook must be passed to every train/evaluate/predict call using
+    # the input_fn; both can be reused across calls.
+    hook = _FeedArraysHook()
+    n = x.shape[0]
+
+    def input_fn():
+        x_ph = tf.compat.v1.placeholder(x.dtype, x.shape)
+        y_ph = tf.compat.v1.placeholder(y.dtype, y.shape) if y is not None else None
+        indices = tf.data.Dataset.range(n)
+        if shuffle:
+            indices = indices.shuffle(n, reshuffle_each_iteration=True).batch(batch_size, drop_remainder=True).repeat()
+        else:
+            indices = indices.batch(batch_size)
+        if y is None:
+            dataset = indices.map(lambda idx: {'x': tf.gather(x_ph, idx)})
+        else:
+            dataset = indices.map(lambda idx: ({'x': tf.gather(x_ph, idx)}, tf.gather(y_ph, idx)))
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        hook.initializer = iterator.initializer
+        hook.feed_dict = {x_ph: x} if y is None else {x_ph: x, y_ph: y}
+        return iterator.get_next()
+
+    return input_fn, hook
+
+
+def predict(classifier, x):
+    input_fn, hook = get_input_fn(x)
     pred_y, pred_scores = [], []
-    val = next(predictions, None)
-    while val is not None:
+    for val in classifier.predict(input_fn=input_fn, hooks=[hook], yield_single_examples=False):
         pred_y.append(val['classes'])
         pred_scores.append(val['probabilities'])
-        val = next(predictions, None)
-    return np.array(pred_y), np.array(pred_scores)
+    if len(pred_y) == 0:
+        return np.array(pred_y), np.array(pred_scores)
+    return np.concatenate(pred_y), np.concatenate(pred_scores)
 
 
-def get_model(features, labels, mode, params):
-    n, n_in, n_hidden, n_out, non_linearity, model, privacy, dp, epsilon, delta, batch_size, learning_rate, clipping_threshold, l2_ratio, epochs = params
+def _trainable_variable_names(params):
+    # names of the weights of the model with these params, in the order get_layers creates them
+    with tf.Graph().as_default():
+        get_model({'x': tf.compat.v1.placeholder(tf.float32, [None, params[1]])}, None, tf.estimator.ModeKeys.PREDICT, params)
+        return [v.op.name for v in tf.compat.v1.trainable_variables()]
+
+
+def export_model(classifier, path, aux=None):
+    # Saves the trained weights and the configuration of a model to a compressed npz file,
+    # without the optimizer state and graph kept in its checkpoint. aux holds the train and
+    # test loss and accuracy of a target model.
+    params = classifier.params
+    names = _trainable_variable_names(params)
+    config = {'params': params, 'names': names, 'aux': None if aux is None else [float(a) for a in aux]}
+    # written to a temporary file first, so that an interrupted export leaves no partial model
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, *[classifier.get_variable_value(name) for name in names], config=json.dumps(config))
+    os.replace(path + '.tmp', path)
+
+
+def _model_from_weights(params, weights, model_dir=None):
+    # model for prediction, with the weights in the order of _trainable_variable_names; it is
+    # transient unless a model_dir is given to persist it
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(dir=get_model_storage())
+    elif os.path.exists(model_dir):
+        shutil.rmtree(model_dir)
+    with tf.Graph().as_default():
+        tf.compat.v1.train.get_or_create_global_step()
+        get_model({'x': tf.compat.v1.placeholder(tf.float32, [None, params[1]])}, None, tf.estimator.ModeKeys.PREDICT, params)
+        with tf.compat.v1.Session(config=SESSION_CONFIG) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            sess.run([variable.assign(value) for variable, value in zip(tf.compat.v1.trainable_variables(), weights)])
+            tf.compat.v1.train.Saver().save(sess, os.path.join(model_dir, 'model.ckpt'))
+    run_config = tf.estimator.RunConfig(model_dir=model_dir, session_config=SESSION_CONFIG, log_step_count_steps=None)
+    return tf.estimator.Estimator(model_fn=get_model, config=run_config, params=params)
+
+
+def load_model(path):
+    # Rebuilds a transient model for prediction from the weights saved by export_model, and
+    # returns it with its aux information
+    with np.load(path) as f:
+        config = json.loads(str(f['config']))
+        weights = [f['arr_%d' % i] for i in range(len(config['names']))]
+    return _model_from_weights(config['params'], weights), config['aux']
+
+
+def get_layers(n_in, n_hidden, n_out, non_linearity, model, l2_ratio):
     if model == 'nn':
         #print('Using neural network...')
-        input_layer = tf.reshape(features['x'], [-1, n_in])
-        y = tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(input_layer)
-        y = tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(y)
-        logits = tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(y)
+        input_shape = [-1, n_in]
+        layers = [
+            tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)),
+            tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)),
+            tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio))]
     elif model == 'cnn':
         #print('Using convolution neural network...') # use only on Cifar-100
-        input_layer = tf.reshape(features['x'], [-1, 32, 32, 3])
-        y = tf.keras.layers.Conv2D(32, kernel_size=(3, 3), activation=non_linearity).apply(input_layer)
-        y = tf.keras.layers.MaxPooling2D(pool_size=(2, 2)).apply(y)
-        y = tf.keras.layers.Conv2D(64, kernel_size=(3, 3), activation=non_linearity, input_shape=[-1, 32, 32, 3]).apply(y)
-        y = tf.keras.layers.MaxPooling2D(pool_size=(2, 2)).apply(y)
-        y = tf.keras.layers.Conv2D(128, kernel_size=(3, 3), activation=non_linearity, input_shape=[-1, 32, 32, 3]).apply(y)
-        y = tf.keras.layers.MaxPooling2D(pool_size=(2, 2)).apply(y)
-        y = tf.keras.layers.Flatten().apply(y)
-        y = tf.nn.dropout(y, 0.2)
-        y = tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(y)
-        y = tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(y)
-        logits = tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(y)
+        input_shape = [-1, 32, 32, 3]
+        layers = [
+            tf.keras.layers.Conv2D(32, kernel_size=(3, 3), activation=non_linearity),
+            tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
+            tf.keras.layers.Conv2D(64, kernel_size=(3, 3), activation=non_linearity, input_shape=[-1, 32, 32, 3]),
+            tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
+            tf.keras.layers.Conv2D(128, kernel_size=(3, 3), activation=non_linearity, input_shape=[-1, 32, 32, 3]),
+            tf.keras.layers.MaxPooling2D(pool_size=(2, 2)),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Lambda(lambda y: tf.nn.dropout(y, 0.2)),
+            tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)),
+            tf.keras.layers.Dense(n_hidden, activation=non_linearity, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)),
+            tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio))]
     else:
         #print('Using softmax regression...')
-        input_layer = tf.reshape(features['x'], [-1, n_in])
-        logits = tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio)).apply(input_layer)
+        input_shape = [-1, n_in]
+        layers = [
+            tf.keras.layers.Dense(n_out, activation=tf.nn.softmax, kernel_regularizer=tf.keras.regularizers.l2(l2_ratio))]
+    return input_shape, layers
+
+
+def forward(x, input_shape, layers):
+    y = tf.reshape(x, input_shape)
+    for layer in layers:
+        y = layer.apply(y)
+    return y
+
+
+def get_vectorized_dp_gradients(x, labels, input_shape, layers, clipping_threshold, sigma, batch_size):
+    # Computes the same update as DPAdamGaussianOptimizer with num_microbatches=batch_size
+    # (per-example clipping to l2 norm clipping_threshold, Gaussian noise with stddev
+    # clipping_threshold * sigma added to the sum, averaged over the batch), but the
+    # per-example gradients of the whole batch are computed by one vectorized op.
+    var_list = [v for layer in layers for v in layer.trainable_weights]
+
+    def clipped_example_gradient(example):
+        x_i, y_i = example
+        loss_i = tf.keras.losses.sparse_categorical_crossentropy(tf.expand_dims(y_i, 0), forward(tf.expand_dims(x_i, 0), input_shape, layers))
+        grads_i = tf.gradients(tf.reduce_sum(loss_i), var_list)
+        grads_i, _ = tf.clip_by_global_norm(grads_i, clipping_threshold)
+        return grads_i
+
+    example_grads = tf.vectorized_map(clipped_example_gradient, (x, labels))
+    grads = []
+    for g in example_grads:
+        g = tf.reduce_sum(g, axis=0)
+        g += tf.random.normal(tf.shape(g), stddev=clipping_threshold * sigma)
+        grads.append(g / batch_size)
+    return list(zip(grads, var_list))
+
+
+def get_model(features, labels, mode, params):
+    n, n_in, n_hidden, n_out, non_linearity, model, privacy, dp, epsilon, delta, batch_size, learning_rate, clipping_threshold, l2_ratio, epochs, dp_optimizer_impl = params
+    input_shape, layers = get_layers(n_in, n_hidden, n_out, non_linearity, model, l2_ratio)
+    logits = forward(features['x'], input_shape, layers)
     
     predictions = {
       "classes": tf.argmax(input=logits, axis=1),
@@ -62,7 +281,13 @@ def get_model(features, labels, mode, params):
     scalar_loss = tf.reduce_mean(vector_loss)
 
     if mode == tf.estimator.ModeKeys.TRAIN:
-        
+        # per-example loss of the records fed to it, with the same weights; only _TrajectoryHook runs it
+        trajectory_x = tf.compat.v1.placeholder(features['x'].dtype, [None, n_in])
+        trajectory_y = tf.compat.v1.placeholder(labels.dtype, [None])
+        trajectory_loss = tf.keras.losses.sparse_categorical_crossentropy(trajectory_y, forward(trajectory_x, input_shape, layers))
+        for tensor in (trajectory_x, trajectory_y, trajectory_loss):
+            tf.compat.v1.add_to_collection(TRAJECTORY_COLLECTION, tensor)
+
         if privacy == 'grad_pert':
             if dp == 'adv_cmp':
                 sigma = np.sqrt(epochs * np.log(2.5 * epochs / delta)) * (np.sqrt(np.log(2 / delta) + 2 * epsilon) + np.sqrt(np.log(2 / delta))) / epsilon
@@ -75,18 +300,27 @@ def get_model(features, labels, mode, params):
             else: # if dp == 'dp'
                 sigma = epochs * np.sqrt(2 * np.log(1.25 * epochs / delta)) / epsilon
     
-            optimizer = dp_optimizer.DPAdamGaussianOptimizer(
-                            l2_norm_clip=clipping_threshold,
-                            noise_multiplier=sigma,
-                            num_microbatches=batch_size,
-                            learning_rate=learning_rate,
-                            ledger=None)
+            if dp_optimizer_impl == 'vectorized':
+                optimizer = AdamOptimizer(learning_rate=learning_rate)
+                dp_grads_and_vars = get_vectorized_dp_gradients(features['x'], labels, input_shape, layers, clipping_threshold, sigma, batch_size)
+            elif dp_optimizer_impl == 'microbatch':
+                optimizer = dp_optimizer.DPAdamGaussianOptimizer(
+                                l2_norm_clip=clipping_threshold,
+                                noise_multiplier=sigma,
+                                num_microbatches=batch_size,
+                                learning_rate=learning_rate,
+                                ledger=None)
+            else:
+                raise ValueError('unknown DP optimizer %s, choose vectorized or microbatch' % dp_optimizer_impl)
             opt_loss = vector_loss
         else:
             optimizer = AdamOptimizer(learning_rate=learning_rate)
             opt_loss = scalar_loss
         global_step = tf.compat.v1.train.get_global_step()
-        train_op = optimizer.minimize(loss=opt_loss, global_step=global_step)
+        if privacy == 'grad_pert' and dp_optimizer_impl == 'vectorized':
+            train_op = optimizer.apply_gradients(dp_grads_and_vars, global_step=global_step)
+        else:
+            train_op = optimizer.minimize(loss=opt_loss, global_step=global_step)
         return tf.estimator.EstimatorSpec(mode=mode,
                                           loss=scalar_loss,
                                           train_op=train_op)
@@ -104,7 +338,46 @@ def get_model(features, labels, mode, params):
                                           eval_metric_ops=eval_metric_ops)
 
 
-def train(dataset, n_hidden=50, batch_size=100, epochs=100, learning_rate=0.01, clipping_threshold=1, model='nn', l2_ratio=1e-7, silent=True, non_linearity='relu', privacy='no_privacy', dp = 'dp', epsilon=0.5, delta=1e-5):
+def uses_lbfgs(solver, model, privacy):
+    # the models that train() fits by L-BFGS; every other model is trained with Adam
+    return solver == 'lbfgs' and model == 'softmax' and privacy == 'no_privacy'
+
+
+def _fit_softmax_lbfgs(train_x, train_y, n_out, l2_ratio, max_iter=LBFGS_MAX_ITER):
+    # Minimizes the mean cross entropy plus l2_ratio * squared kernel weights of the softmax
+    # model over the whole training set with L-BFGS. The products are computed in the precision
+    # of the data, so that large data sets are not copied to float64.
+    n, n_in = train_x.shape
+    one_hot = np.eye(n_out, dtype=train_x.dtype)[train_y]
+
+    def objective(w):
+        W, b = w[:n_in * n_out].reshape(n_in, n_out), w[n_in * n_out:]
+        z = train_x @ W.astype(train_x.dtype) + b.astype(train_x.dtype)
+        log_p = z - special.logsumexp(z, axis=1, keepdims=True)
+        loss = -np.sum(one_hot * log_p, dtype=np.float64) / n + l2_ratio * np.sum(W**2)
+        d = (np.exp(log_p) - one_hot) / n
+        grad_W = (train_x.T @ d).astype(np.float64) + 2 * l2_ratio * W
+        return loss, np.concatenate([grad_W.ravel(), d.sum(axis=0, dtype=np.float64)])
+
+    result = optimize.minimize(objective, np.zeros(n_in * n_out + n_out), jac=True, method='L-BFGS-B', options={'maxiter': max_iter})
+    return [result.x[:n_in * n_out].reshape(n_in, n_out).astype(np.float32), result.x[n_in * n_out:].astype(np.float32)]
+
+
+def _softmax_loss_and_accuracy(weights, x, y):
+    # same loss and accuracy as the evaluation of the softmax model
+    W, b = weights
+    p = special.softmax(x @ W + b, axis=1)
+    p_y = np.clip(p[np.arange(len(y)), y], 1e-7, 1 - 1e-7)
+    return float(np.mean(-np.log(p_y))), float(np.mean(np.argmax(p, axis=1) == y))
+
+
+def train(dataset, n_hidden=50, batch_size=100, epochs=100, learning_rate=0.01, clipping_threshold=1, model='nn', l2_ratio=1e-7, silent=True, non_linearity='relu', privacy='no_privacy', dp = 'dp', epsilon=0.5, delta=1e-5, dp_optimizer_impl='microbatch', model_dir=None, session_config=None, solver='adam', trajectory_epochs=None, trajectory_path=None, name='model'):
+    # solver='lbfgs' fits the softmax model without privacy by full-batch L-BFGS instead of
+    # epochs of mini-batch Adam; every other model is trained with Adam. With trajectory_epochs,
+    # the per-example losses of the training then the test records after each of these epochs
+    # are written to a (len(trajectory_epochs), n_train + n_test) float32 array memory mapped
+    # from the .npy file trajectory_path. The name is the model's role (e.g. target or shadow_0),
+    # which labels its profiler traces.
     train_x, train_y, test_x, test_y = dataset
 
     n_in = train_x.shape[1]
@@ -113,78 +386,164 @@ def train(dataset, n_hidden=50, batch_size=100, epochs=100, learning_rate=0.01,
     if batch_size > len(train_y):
         batch_size = len(train_y)
 
+    params = [
+        train_x.shape[0],
+        n_in,
+        n_hidden,
+        n_out,
+        non_linearity,
+        model,
+        privacy,
+        dp,
+        epsilon,
+        delta,
+        batch_size,
+        learning_rate,
+        clipping_threshold,
+        l2_ratio,
+        epochs,
+        dp_optimizer_impl
+    ]
+
+    if uses_lbfgs(solver, model, privacy):
+        if trajectory_epochs:
+            print('No loss trajectory is recorded for a model fit by L-BFGS, which has no epochs')
+        weights = _fit_softmax_lbfgs(train_x, train_y, n_out, l2_ratio)
+        classifier = _model_from_weights(params, weights, model_dir)
+        if silent:
+            return classifier
+        train_loss, train_acc = _softmax_loss_and_accuracy(weights, train_x, train_y)
+        print('Train accuracy is: %.3f' % (train_acc))
+        test_loss, test_acc = _softmax_loss_and_accuracy(weights, test_x, test_y)
+        print('Test accuracy is: %.3f' % (test_acc))
+        return classifier, (train_loss, train_acc, test_loss, test_acc)
+
+    # models are transient unless a model_dir is given to persist them
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(dir=get_model_storage())
+    elif os.path.exists(model_dir):
+        shutil.rmtree(model_dir) # otherwise training would resume from the stale checkpoint
+    config = tf.estimator.RunConfig(
+            model_dir=model_dir,
+            session_config=session_config if session_config is not None else SESSION_CONFIG,
+            save_summary_steps=0,
+            keep_checkpoint_max=1,
+            log_step_count_steps=None)
+
     classifier = tf.estimator.Estimator(
             model_fn=get_model,
-            params = [
-                train_x.shape[0],
-                n_in,
-                n_hidden,
-                n_out,
-                non_linearity,
-                model,
-                privacy,
-                dp,
-                epsilon,
-                delta,
-                batch_size,
-                learning_rate,
-                clipping_threshold,
-                l2_ratio,
-                epochs
-            ])
-
-    train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': train_x},
-        y=train_y,
-        batch_size=batch_size,
-        num_epochs=epochs,
-        shuffle=True)
-    train_eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': train_x},
-        y=train_y,
-        num_epochs=1,
-        shuffle=False)
-    test_eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': test_x},
-        y=test_y,
-        num_epochs=1,
-        shuffle=False)
+            config=config,
+            params=params)
+
+    train_input_fn, train_hook = get_input_fn(train_x, train_y, batch_size=batch_size, shuffle=True)
+    train_eval_input_fn, train_eval_hook = get_input_fn(train_x, train_y)
+    test_eval_input_fn, test_eval_hook = get_input_fn(test_x, test_y)
 
     steps_per_epoch = train_x.shape[0] // batch_size
 
+    trajectory_hooks = []
+    if trajectory_epochs:
+        if os.path.dirname(trajectory_path) and not os.path.exists(os.path.dirname(trajectory_path)):
+            os.makedirs(os.path.dirname(trajectory_path))
+        trajectory = np.lib.format.open_memmap(trajectory_path, mode='w+', dtype=np.float32, shape=(len(trajectory_epochs), len(train_x) + len(test_x)))
+        trajectory_hooks.append(_TrajectoryHook(np.concatenate([train_x, test_x]), np.concatenate([train_y, test_y]), steps_per_epoch, trajectory_epochs, trajectory))
+
     if not os.path.exists(LOG_DIR):
        os.makedirs(LOG_DIR)
-    for epoch in range(1, epochs + 1):
-        hooks = []
+    # without per-epoch evaluation all epochs run in a single training call over the
+    # same input pipeline, instead of rebuilding the graph after every epoch
+    epoch_steps = [steps_per_epoch] * epochs if not silent else [steps_per_epoch * epochs]
+    for epoch, steps in enumerate(epoch_steps, 1):
+        hooks = [train_hook] + trajectory_hooks
         if LOGGING:
+            # each model traces into its own subdirectory under that of its role, which
+            # combine_traces.py uses as its label
             hooks.append(tf.train.ProfilerHook(
-                output_dir=LOG_DIR,
+                output_dir=os.path.join(LOG_DIR, name, os.path.basename(os.path.normpath(model_dir))),
                 save_steps=30))
         # This hook will save traces of what tensorflow is doing
         # during the training of each model. View the combined trace
         # by running `combine_traces.py`
 
         classifier.train(input_fn=train_input_fn,
-                steps=steps_per_epoch,
+                steps=steps,
                 hooks=hooks)
     
         if not silent:
-            eval_results = classifier.evaluate(input_fn=train_eval_input_fn)
+            eval_results = classifier.evaluate(input_fn=train_eval_input_fn, hooks=[train_eval_hook])
             print('Train loss after %d epochs is: %.3f' % (epoch, eval_results['loss']))
 
     if not silent:
-        eval_results = classifier.evaluate(input_fn=train_eval_input_fn)
+        eval_results = classifier.evaluate(input_fn=train_eval_input_fn, hooks=[train_eval_hook])
         train_loss = eval_results['loss']
         train_acc = eval_results['accuracy']
         print('Train accuracy is: %.3f' % (train_acc))
 
-        eval_results = classifier.evaluate(input_fn=test_eval_input_fn)
+        eval_results = classifier.evaluate(input_fn=test_eval_input_fn, hooks=[test_eval_hook])
         test_loss = eval_results['loss']
         test_acc = eval_results['accuracy']
         print('Test accuracy is: %.3f' % (test_acc))
 
+        if trajectory_epochs:
+            trajectory.flush()
         # warning: silent flag is only used for target model training, 
         # as it also returns auxiliary information
         return classifier, (train_loss, train_acc, test_loss, test_acc)
 
+    if trajectory_epochs:
+        trajectory.flush()
     return classifier
+
+
+def train_stacked(datasets, n_hidden=50, batch_size=100, epochs=100, learning_rate=0.01, model='nn', l2_ratio=1e-7, non_linearity='relu'):
+    # Trains one model of the same architecture on each data set, all at once in a single graph:
+    # the weights of the models are stacked along a leading axis, each step takes one batch from
+    # every data set and the batched forward pass multiplies all the models together. Adam's
+    # updates are elementwise and the models' losses are summed, so each model follows the same
+    # updates as when trained alone by train() without privacy. Returns a transient model for
+    # prediction per data set.
+    if model not in ['nn', 'softmax']:
+        raise ValueError('stacked training supports the nn and softmax models, not ' + model)
+    train_x = np.stack([d[0] for d in datasets]).astype(np.float32)
+    train_y = np.stack([d[1] for d in datasets]).astype(np.int32)
+    n_models, n, n_in = train_x.shape
+    n_out = len(np.unique(train_y[0]))
+    if any(len(np.unique(y)) != n_out for y in train_y):
+        raise ValueError('stacked models must all have the same number of classes')
+    batch_size = min(batch_size, n)
+    params = [n, n_in, n_hidden, n_out, non_linearity, model, 'no_privacy', 'dp', 0.5, 1e-5, batch_size, learning_rate, 1, l2_ratio, epochs, 'microbatch']
+    # the units of each dense layer, which are initialized as by the keras layers of get_layers
+    sizes = [n_in, n_hidden, n_hidden, n_out] if model == 'nn' else [n_in, n_out]
+    activation = getattr(tf.nn, non_linearity)
+
+    with tf.Graph().as_default():
+        # the arrays are fed once into variables rather than embedded in the graph
+        x_ph = tf.compat.v1.placeholder(tf.float32, train_x.shape)
+        y_ph = tf.compat.v1.placeholder(tf.int32, train_y.shape)
+        x_all = tf.compat.v1.Variable(x_ph, trainable=False)
+        y_all = tf.compat.v1.Variable(y_ph, trainable=False)
+        # the records of each model's batch, drawn from its own shuffle of its data set
+        batch_ph = tf.compat.v1.placeholder(tf.int32, [n_models, batch_size])
+        y = tf.gather(x_all, batch_ph, batch_dims=1)
+        weights = []
+        for i, (fan_in, fan_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+            limit = np.sqrt(6. / (fan_in + fan_out))
+            kernel = tf.compat.v1.Variable(tf.random.uniform([n_models, fan_in, fan_out], -limit, limit))
+            bias = tf.compat.v1.Variable(tf.zeros([n_models, 1, fan_out]))
+            weights += [kernel, bias]
+            y = tf.matmul(y, kernel) + bias
+            y = tf.nn.softmax(y) if i == len(sizes) - 2 else activation(y)
+        # as in get_model, the training loss is the mean cross entropy of each model's batch
+        vector_loss = tf.keras.losses.sparse_categorical_crossentropy(tf.gather(y_all, batch_ph, batch_dims=1), y)
+        train_op = AdamOptimizer(learning_rate=learning_rate).minimize(tf.reduce_sum(tf.reduce_mean(vector_loss, axis=1)))
+
+        steps_per_epoch = n // batch_size
+        with tf.compat.v1.Session(config=SESSION_CONFIG) as sess:
+            sess.run(tf.compat.v1.global_variables_initializer(), feed_dict={x_ph: train_x, y_ph: train_y})
+            for epoch in range(epochs):
+                order = np.argsort(np.random.rand(n_models, n), axis=1).astype(np.int32)
+                for step in range(steps_per_epoch):
+                    sess.run(train_op, feed_dict={batch_ph: order[:, step * batch_size:(step + 1) * batch_size]})
+            values = sess.run(weights)
+    # kernels and biases alternate, and the biases lose their broadcast axis as in the dense layers
+    return [_model_from_weights(params, [w[m] if j % 2 == 0 else w[m, 0] for j, w in enumerate(values)]) for m in range(n_models)]
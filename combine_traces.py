@@ -1,25 +1,62 @@
+import argparse
 import json
+import os
+from collections import defaultdict
 from glob import glob
 
-# directory containing the timeline-*.json partial traces
-dir = 'log'
+parser = argparse.ArgumentParser()
+# directory containing the timeline-*.json partial traces, in one subdirectory per model
+# under a subdirectory per role (target, shadow_0, reference, attack_0, ...)
+parser.add_argument('--log_dir', type=str, default='log')
+parser.add_argument('--output', type=str, default='traceEvents.json')
+parser.add_argument('--top', type=int, default=20)
+args = parser.parse_args()
 
-output = dict() # json object that will be written out
-output['traceEvents'] = []
-labels = set()
-for trace in glob(f'{dir}/timeline-*.json'):
-    with open(trace) as f:
-        for node in json.loads(f.read())['traceEvents']:
-            if 'dur' in node: # keep nodes that have a "dur"ation
-                output['traceEvents'].append(node)
-            elif node['name'] == 'process_name':
-                labels.add(tuple(node))
-            # ignore all others, I can't tell what they're for
+pids = dict() # (model label, source pid) -> pid in the combined trace
+op_time = defaultdict(float)
+op_count = defaultdict(int)
+n_traces = 0
+n_events = 0
 
-# convert sets to lists for JSON printing
-output['traceEvents'] = [list(a) for a in labels] + output['traceEvents']
-with open('traceEvents.json', 'w') as f:
-    f.write(json.dumps(output))
+traces = sorted(glob(os.path.join(args.log_dir, '**', 'timeline-*.json'), recursive=True))
+with open(args.output, 'w') as out:
+    # the combined trace is written one event at a time, so only a single
+    # partial trace is held in memory at once
+    out.write('{"traceEvents": [')
+    first = True
+    for trace in traces:
+        # the models of a role share its label
+        label = os.path.relpath(os.path.dirname(trace), args.log_dir).split(os.sep)[0]
+        if label == '.':
+            label = 'default'
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        n_traces += 1
+        process_names = {node['pid']: node['args']['name'] for node in events if node.get('name') == 'process_name'}
+        for node in events:
+            if 'dur' not in node: # skip nodes without a "dur"ation
+                continue
+            key = (label, node['pid'])
+            if key not in pids:
+                pids[key] = len(pids)
+                meta = {'name': 'process_name', 'ph': 'M', 'pid': pids[key],
+                        'args': {'name': '%s %s' % (label, process_names.get(node['pid'], node['pid']))}}
+                out.write(('' if first else ',') + json.dumps(meta))
+                first = False
+            node['pid'] = pids[key]
+            out.write(('' if first else ',') + json.dumps(node))
+            first = False
+            n_events += 1
+            op_time[node['name']] += node['dur']
+            op_count[node['name']] += 1
+        del events
+    out.write(']}')
+
+print('Merged %d events from %d traces of %d model roles into %s' % (n_events, n_traces, len(set(k[0] for k in pids)), args.output))
+print('-' * 10 + 'TOP %d OPS BY TOTAL DURATION' % args.top + '-' * 10)
+total = sum(op_time.values())
+for name in sorted(op_time, key=op_time.get, reverse=True)[:args.top]:
+    print('%-40s %12.3f ms  %6.2f%%  %8d calls' % (name, op_time[name] / 1000, 100 * op_time[name] / max(total, 1), op_count[name]))
 
 # To view the trace:
 # - Go to "chrome://tracing" in Google Chrome or Chromium
@@ -1,76 +1,135 @@
-from attack import save_data, load_data, train_target_model, yeom_membership_inference, shokri_membership_inference, yeom_attribute_inference
-from utilities import log_loss, get_random_features
-from sklearn.metrics import roc_curve
+from attack import MODEL_PATH, save_data, load_data, train_target_model, yeom_membership_inference, shokri_membership_inference, yeom_attribute_inference
+from utilities import save_result, log_loss, get_random_features, claim_cpu_partition, profile_phase, start_phase_profile, save_phase_profile, open_phase_checkpoints, run_phase, clear_phase_checkpoints, PHASE_CHECKPOINT_SUBDIR, lazy_import
 import numpy as np
 import argparse
 import os
-import pickle
+
+# TensorFlow is not imported when only the data is being prepared
+models = lazy_import('classifier')
+metrics = lazy_import('sklearn.metrics')
 
 RESULT_PATH = 'results/'
 
 if not os.path.exists(RESULT_PATH):
     os.makedirs(RESULT_PATH)
 
+def get_result_path(args):
+    if args.target_privacy == 'no_privacy':
+        return RESULT_PATH+args.train_dataset+'/'+args.target_model+'_'+'no_privacy_'+str(args.target_l2_ratio)+'.p'
+    return RESULT_PATH+args.train_dataset+'/'+args.target_model+'_'+args.target_privacy+'_'+args.target_dp+'_'+str(args.target_epsilon)+'_'+str(args.run)+'.p'
+
+def get_export_dir(args):
+    # exported models are keyed by the same configuration as the result file
+    return MODEL_PATH+args.train_dataset+'/'+os.path.splitext(os.path.basename(get_result_path(args)))[0]+'/'
+
+def get_trajectory_epochs(args):
+    # epochs after which the per-example losses of the target model are recorded
+    return [int(epoch) for epoch in args.trajectory_epochs.split(',')] if args.trajectory_epochs else None
+
+def check_args(args):
+    # options that would otherwise only fail, or be ignored, once training has started
+    try:
+        trajectory_epochs = get_trajectory_epochs(args) or []
+    except ValueError:
+        return '--trajectory_epochs must be a comma-separated list of epochs, not ' + args.trajectory_epochs
+    if not all(1 <= epoch <= args.target_epochs for epoch in trajectory_epochs):
+        # the rows of the epochs that are never reached would be left as zeros
+        return '--trajectory_epochs must be between 1 and --target_epochs (%d), not %s' % (args.target_epochs, args.trajectory_epochs)
+    return None
+
 def run_experiment(args):
+    if check_args(args):
+        raise ValueError(check_args(args))
     print('-' * 10 + 'TRAIN TARGET' + '-' * 10 + '\n')
+    # phase checkpoints are kept with the exported models of the experiment; without
+    # --export_models, in a subdirectory of their own that leaves earlier exports alone
+    export_dir = get_export_dir(args) if args.export_models else (get_export_dir(args) + PHASE_CHECKPOINT_SUBDIR if args.checkpoint_phases else None)
+    checkpoint_dir = export_dir if args.checkpoint_phases else None
+    if export_dir is not None and not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    open_phase_checkpoints(checkpoint_dir, args)
     dataset = load_data('target_data.npz', args)
     train_x, train_y, test_x, test_y = dataset
     true_x = np.vstack((train_x, test_x))
     true_y = np.append(train_y, test_y)
     batch_size = args.target_batch_size
 
-    pred_y, membership, test_classes, classifier, aux = train_target_model(
-        args=args,
-        dataset=dataset,
-        epochs=args.target_epochs,
-        batch_size=args.target_batch_size,
-        learning_rate=args.target_learning_rate,
-        clipping_threshold=args.target_clipping_threshold,
-        n_hidden=args.target_n_hidden,
-        l2_ratio=args.target_l2_ratio,
-        model=args.target_model,
-        privacy=args.target_privacy,
-        dp=args.target_dp,
-        epsilon=args.target_epsilon,
-        delta=args.target_delta,
-        save=args.save_model)
+    classifier = None
+    def target_training():
+        nonlocal classifier
+        # only profiled when the model is trained, not when a completed phase is resumed
+        with profile_phase('target_training', len(train_x) * args.target_epochs):
+            pred_y, membership, test_classes, classifier, aux = train_target_model(
+                args=args,
+                dataset=dataset,
+                epochs=args.target_epochs,
+                batch_size=args.target_batch_size,
+                learning_rate=args.target_learning_rate,
+                clipping_threshold=args.target_clipping_threshold,
+                n_hidden=args.target_n_hidden,
+                l2_ratio=args.target_l2_ratio,
+                model=args.target_model,
+                privacy=args.target_privacy,
+                dp=args.target_dp,
+                epsilon=args.target_epsilon,
+                delta=args.target_delta,
+                dp_optimizer_impl=args.target_dp_optimizer,
+                save=args.save_model,
+                model_dir=MODEL_PATH + 'target_model/' if args.save_model else None,
+                solver=args.target_solver,
+                trajectory_epochs=get_trajectory_epochs(args),
+                trajectory_path=os.path.splitext(get_result_path(args))[0] + '_trajectory.npy',
+                export_path=export_dir + 'target.npz' if export_dir is not None else None)
+        return pred_y, membership, test_classes, aux
+
+    pred_y, membership, test_classes, aux = run_phase(checkpoint_dir, 'target_training', target_training)
+    if classifier is None:
+        # the target model was trained before the run was restarted
+        classifier, _ = models.load_model(export_dir + 'target.npz')
     train_loss, train_acc, test_loss, test_acc = aux
     per_instance_loss = np.array(log_loss(true_y, pred_y))
-   
-    features = get_random_features(true_x, range(true_x.shape[1]), 5)
-    print(features)
 
     # Yeom's membership inference attack when only train_loss is known 
     pred_membership = yeom_membership_inference(per_instance_loss, membership, train_loss)
-    fpr, tpr, thresholds = roc_curve(membership, pred_membership, pos_label=1)
+    fpr, tpr, thresholds = metrics.roc_curve(membership, pred_membership, pos_label=1)
     yeom_mem_adv = tpr[1] - fpr[1]
 
     # Shokri's membership inference attack based on shadow model training
-    shokri_mi_outputs = shokri_membership_inference(args, pred_y, membership, test_classes)
+    shokri_mi_outputs = run_phase(checkpoint_dir, 'shokri', lambda: shokri_membership_inference(args, pred_y, membership, test_classes, export_dir=export_dir))
     shokri_mem_adv, _, shokri_mem_confidence, _, _, _, _ = shokri_mi_outputs
 
     # Yeom's attribute inference attack when train_loss is known - Adversary 4 of Yeom et al.
-    pred_membership_all = yeom_attribute_inference(true_x, true_y, classifier, membership, features, train_loss)
+    def attribute_inference():
+        # the attacked features are saved with the attack outputs, so a resumed run evaluates the same features
+        features = get_random_features(true_x, range(true_x.shape[1]), 5)
+        print(features)
+        with profile_phase('attribute_inference', 2 * len(true_x) * len(features)):
+            return features, yeom_attribute_inference(true_x, true_y, classifier, membership, features, train_loss)
+    features, pred_membership_all = run_phase(checkpoint_dir, 'attribute_inference', attribute_inference)
     yeom_attr_adv = []
     for pred_membership in pred_membership_all:
-        fpr, tpr, thresholds = roc_curve(membership, pred_membership, pos_label=1)
+        fpr, tpr, thresholds = metrics.roc_curve(membership, pred_membership, pos_label=1)
         yeom_attr_adv.append(tpr[1] - fpr[1])
     
     if not os.path.exists(RESULT_PATH+args.train_dataset):
         os.makedirs(RESULT_PATH+args.train_dataset)
     
-    if args.target_privacy == 'no_privacy':
-        pickle.dump([train_acc, test_acc, train_loss, membership, shokri_mem_adv, shokri_mem_confidence, yeom_mem_adv, per_instance_loss, yeom_attr_adv, pred_membership_all, features], open(RESULT_PATH+args.train_dataset+'/'+args.target_model+'_'+'no_privacy_'+str(args.l2_ratio)+'.p', 'wb'))
-    else:
-        pickle.dump([train_acc, test_acc, train_loss, membership, shokri_mem_adv, shokri_mem_confidence, yeom_mem_adv, per_instance_loss, yeom_attr_adv, pred_membership_all, features], open(RESULT_PATH+args.train_dataset+'/'+args.target_model+'_'+args.target_privacy+'_'+args.target_dp+'_'+str(args.target_epsilon)+'_'+str(args.run)+'.p', 'wb'))
+    save_result([train_acc, test_acc, train_loss, membership, shokri_mem_adv, shokri_mem_confidence, yeom_mem_adv, per_instance_loss, yeom_attr_adv, pred_membership_all, features], get_result_path(args), compress=args.compact_scores)
+    clear_phase_checkpoints(checkpoint_dir, keep_models=args.export_models)
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('train_dataset', type=str)
     parser.add_argument('--run', type=int, default=1)
     parser.add_argument('--use_cpu', type=int, default=0)
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--cpu_partitions', type=int, default=0)
     parser.add_argument('--save_model', type=int, default=0)
+    parser.add_argument('--export_models', type=int, default=0)
     parser.add_argument('--save_data', type=int, default=0)
+    parser.add_argument('--profile_phases', type=int, default=0)
+    parser.add_argument('--checkpoint_phases', type=int, default=0)
     # target and shadow model configuration
     parser.add_argument('--n_shadow', type=int, default=5)
     parser.add_argument('--target_data_size', type=int, default=int(1e4))
@@ -86,6 +145,11 @@ if __name__ == '__main__':
     parser.add_argument('--target_dp', type=str, default='dp')
     parser.add_argument('--target_epsilon', type=float, default=0.5)
     parser.add_argument('--target_delta', type=float, default=1e-5)
+    parser.add_argument('--target_dp_optimizer', type=str, default='microbatch', choices=['vectorized', 'microbatch'])
+    # 'lbfgs' fits the softmax model without privacy by full-batch L-BFGS instead of Adam
+    parser.add_argument('--target_solver', type=str, default='adam', choices=['adam', 'lbfgs'])
+    # comma-separated epochs after which the per-example losses of the target model are recorded, e.g. 1,10,100
+    parser.add_argument('--trajectory_epochs', type=str, default='')
     # attack model configuration
     parser.add_argument('--attack_model', type=str, default='nn')
     parser.add_argument('--attack_learning_rate', type=float, default=0.01)
@@ -93,9 +157,19 @@ if __name__ == '__main__':
     parser.add_argument('--attack_n_hidden', type=int, default=64)
     parser.add_argument('--attack_epochs', type=int, default=100)
     parser.add_argument('--attack_l2_ratio', type=float, default=1e-6)
+    parser.add_argument('--attack_backend', type=str, default='tf', choices=['tf', 'numpy'])
+    # keep only the top k sorted scores for Shokri's attack, in half precision, and compress the result file (0 keeps all)
+    parser.add_argument('--compact_scores', type=int, default=0)
+    # train all the shadow models at once as one stacked model, for the nn and softmax models without privacy
+    parser.add_argument('--stacked_shadow', type=int, default=0)
+    return parser
 
+if __name__ == '__main__':
     # parse configuration
+    parser = get_parser()
     args = parser.parse_args()
+    if check_args(args):
+        parser.error(check_args(args))
     print(vars(args))
     
     # Flag to disable GPU
@@ -105,4 +179,19 @@ if __name__ == '__main__':
     if args.save_data:
         save_data(args)
     else:
-        run_experiment(args)
+        # Split the node's cores among this many co-located experiments and size the thread pools to this process's share
+        if args.cpu_partitions:
+            cores = claim_cpu_partition(args.cpu_partitions)
+            args.intra_op_threads = args.intra_op_threads or len(cores)
+            args.inter_op_threads = args.inter_op_threads or min(2, len(cores))
+        models.configure_threads(args.intra_op_threads, args.inter_op_threads)
+        if args.profile_phases:
+            start_phase_profile()
+        # transient models are kept in RAM-backed storage that is cleaned up
+        # when the experiment finishes or fails
+        try:
+            with models.model_storage():
+                run_experiment(args)
+        finally:
+            # per-phase timings are written next to the result file, including those of a failed run
+            save_phase_profile(os.path.splitext(get_result_path(args))[0] + '_phases.json')
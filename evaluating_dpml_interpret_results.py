@@ -1,10 +1,12 @@
-from sklearn.metrics import roc_curve, confusion_matrix
-from scipy import stats
-import matplotlib.pyplot as plt
-from matplotlib_venn import venn3
+from utilities import load_result, bootstrap_metrics, print_bootstrap_metrics, lazy_import, batch_confusion_counts, pack_runs, popcount, run_region_counts, revealed_by_at_least, show_figure, render_figures
 import numpy as np
-import pickle
 import argparse
+import sys
+
+# plotting and sklearn are only imported by the functions that use them, so that table output starts quickly
+metrics = lazy_import('sklearn.metrics')
+stats = lazy_import('scipy.stats')
+plt = lazy_import('matplotlib.pyplot')
 
 
 EPS = list(np.arange(0.01, 0.1, 0.01)) + list(np.arange(0.1, 1, 0.1))
@@ -15,14 +17,23 @@ TYPE = ['o-', '.-', '^-', '--']
 DP_LABELS = ['NC', 'AC', 'zCDP', 'RDP']
 RUNS = range(5)
 
-plt.rcParams["font.family"] = "Times New Roman"
-plt.rcParams.update({'font.size': 15})
+def setup_plots():
+	plt.rcParams["font.family"] = "Times New Roman"
+	plt.rcParams.update({'font.size': 15})
 
 
 def theoretical_limit(epsilons):
 	return [np.exp(eps) - 1 for eps in epsilons]
 
 
+def result_file(dp, eps, run):
+	return DATA_PATH+MODEL+PERTURBATION+dp+str(eps)+'_'+str(run+1)+'.p'
+
+
+def no_privacy_file():
+	return DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'.p'
+
+
 def get_data():
 	result = {}
 	for dp in DP:
@@ -30,7 +41,7 @@ def get_data():
 		for eps in EPSILONS:
 			runs = {}
 			for run in RUNS:
-				runs[run] = list(pickle.load(open(DATA_PATH+MODEL+PERTURBATION+dp+str(eps)+'_'+str(run+1)+'.p', 'rb')))
+				runs[run] = list(load_result(result_file(dp, eps, run)))
 			epsilons[eps] = runs
 		result[dp] = epsilons
 	return result
@@ -40,8 +51,8 @@ def pretty_position(X, Y, pos):
 	return ((X[pos] + X[pos+1]) / 2, (Y[pos] + Y[pos+1]) / 2)
 
 
-def plot_advantage(result):
-	train_acc, baseline_acc, train_loss, membership, _, shokri_mem_confidence, _, per_instance_loss, _, per_instance_loss_all, _ = pickle.load(open(DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'.p', 'rb'))
+def plot_advantage(result, plot='acc'):
+	train_acc, baseline_acc, train_loss, membership, _, shokri_mem_confidence, _, per_instance_loss, _, per_instance_loss_all, _ = load_result(no_privacy_file())
 	print(train_acc, baseline_acc)
 	color = 0.1
 	y = dict()
@@ -66,24 +77,24 @@ def plot_advantage(result):
 			yeom_attr_adv_std.append(np.std(yeom_attr_adv_d))
 
 			if args.silent == 0:
-				if args.plot == 'acc':
+				if plot == 'acc':
 					print(dp, eps, (baseline_acc - np.mean(test_acc_d)) / baseline_acc, np.std(test_acc_d))
-				elif args.plot == 'shokri_mi':
+				elif plot == 'shokri_mi':
 					print(dp, eps, np.mean(shokri_mem_adv_d), np.std(shokri_mem_adv_d))
-				elif args.plot == 'yeom_ai':
+				elif plot == 'yeom_ai':
 					print(dp, eps, np.mean(yeom_attr_adv_d), np.std(yeom_attr_adv_d))
-				elif args.plot == 'yeom_mi':
+				elif plot == 'yeom_mi':
 					print(dp, eps, np.mean(yeom_mem_adv_d), np.std(yeom_mem_adv_d))
-		if args.plot == 'acc':
+		if plot == 'acc':
 			y[dp] = (baseline_acc - test_acc_mean) / baseline_acc
 			plt.errorbar(EPSILONS, (baseline_acc - test_acc_mean) / baseline_acc, yerr=test_acc_std, color=str(color), fmt='.-', capsize=2, label=DP_LABELS[DP.index(dp)])
-		elif args.plot == 'shokri_mi':
+		elif plot == 'shokri_mi':
 			y[dp] = shokri_mem_adv_mean
 			plt.errorbar(EPSILONS, shokri_mem_adv_mean, yerr=shokri_mem_adv_std, color=str(color), fmt='.-', capsize=2, label=DP_LABELS[DP.index(dp)])
-		elif args.plot == 'yeom_ai':
+		elif plot == 'yeom_ai':
 			y[dp] = yeom_attr_adv_mean
 			plt.errorbar(EPSILONS, yeom_attr_adv_mean, yerr=yeom_attr_adv_std, color=str(color), fmt='.-', capsize=2, label=DP_LABELS[DP.index(dp)])
-		elif args.plot == 'yeom_mi':
+		elif plot == 'yeom_mi':
 			y[dp] = yeom_mem_adv_mean
 			plt.errorbar(EPSILONS, yeom_mem_adv_mean, yerr=yeom_mem_adv_std, color=str(color), fmt='.-', capsize=2, label=DP_LABELS[DP.index(dp)])
 		color += 0.2
@@ -91,7 +102,7 @@ def plot_advantage(result):
 	plt.xscale('log')
 	plt.xlabel('Privacy Budget ($\epsilon$)')
 
-	if args.plot == 'acc':
+	if plot == 'acc':
 		plt.ylabel('Accuracy Loss')
 		plt.yticks(np.arange(0, 1.1, step=0.2))
 	else:
@@ -107,15 +118,15 @@ def plot_advantage(result):
 	plt.annotate("AC", pretty_position(EPSILONS, y["adv_cmp_"], -4), textcoords="offset points", xytext=(0, -10), ha='left')
 	plt.annotate("NC", pretty_position(EPSILONS, y["dp_"], -4), textcoords="offset points", xytext=(-10, 0), ha='right')
 
-	plt.show()
+	show_figure('advantage_' + plot)
 
 
 def members_revealed_fixed_fpr(result):
 	thres = args.fpr_threshold# 0.01 == 1% FPR, 0.02 == 2% FPR, 0.05 == 5% FPR
-	_, _, train_loss, membership, _, shokri_mem_confidence, _, per_instance_loss, _, per_instance_loss_all, _ = pickle.load(open(DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'.p', 'rb'))
+	_, _, train_loss, membership, _, shokri_mem_confidence, _, per_instance_loss, _, per_instance_loss_all, _ = load_result(no_privacy_file())
 	pred = (max(per_instance_loss) - per_instance_loss) / (max(per_instance_loss) - min(per_instance_loss))
 	#pred = shokri_mem_confidence[:,1]
-	print(len(_members_revealed(membership, pred, thres)))
+	print(np.count_nonzero(_members_revealed(membership, pred, thres)))
 	for dp in DP:
 		for eps in EPSILONS:
 			mems_revealed = []
@@ -124,126 +135,91 @@ def members_revealed_fixed_fpr(result):
 				pred = (max(per_instance_loss) - per_instance_loss) / (max(per_instance_loss) - min(per_instance_loss))
 				#pred = shokri_mem_confidence[:,1]
 				mems_revealed.append(_members_revealed(membership, pred, thres))
-			s = set.intersection(*mems_revealed)
-			print(dp, eps, len(s))
+			# members revealed in every run
+			print(dp, eps, popcount(np.bitwise_and.reduce(pack_runs(mems_revealed), axis=0)))
 
 
 def _members_revealed(membership, prediction, acceptable_fpr):
-	fpr, tpr, thresholds = roc_curve(membership, prediction, pos_label=1)
-	l = list(filter(lambda x: x < acceptable_fpr, fpr))
-	if len(l) == 0:
+	# mask of the members revealed at the largest threshold with fpr below acceptable_fpr
+	fpr, tpr, thresholds = metrics.roc_curve(membership, prediction, pos_label=1)
+	l = np.count_nonzero(fpr < acceptable_fpr)
+	if l == 0:
 		print("Error: low acceptable fpr")
 		return None
-	threshold = thresholds[len(l)-1]
-	preds = list(map(lambda val: 1 if val >= threshold else 0, prediction))
-	tp = [a*b for a,b in zip(preds,membership)]
-	revealed = list(map(lambda i: i if tp[i] == 1 else None, range(len(tp))))
-	return set(list(filter(lambda x: x != None, revealed)))
+	threshold = thresholds[l-1]
+	return (prediction >= threshold) & (membership == 1)
 
 
 def get_ppv(mem, pred):
-	tn, fp, fn, tp = confusion_matrix(mem, pred).ravel()
+	tn, fp, fn, tp = metrics.confusion_matrix(mem, pred).ravel()
 	return tp / (tp + fp)
 
 
-def ppv_across_runs(mem, pred):
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred >= 0, 1, 0)).ravel()
-	print("0 or more")
-	print(tp, fp, tp / (tp + fp))
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred >= 1, 1, 0)).ravel()
-	print("1 or more")
-	print(tp, fp, tp / (tp + fp))
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred >= 2, 1, 0)).ravel()
-	print("2 or more")
-	print(tp, fp, tp / (tp + fp))
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred >= 3, 1, 0)).ravel()
-	print("3 or more")
-	print(tp, fp, tp / (tp + fp))
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred >= 4, 1, 0)).ravel()
-	print("4 or more")
-	print(tp, fp, tp / (tp + fp))
-	tn, fp, fn, tp = confusion_matrix(mem, np.where(pred == 5, 1, 0)).ravel()
-	print("exactly 5")
-	print(tp, fp, tp / (tp + fp))
+def ppv_across_runs(mem, preds):
+	# PPV of the records revealed in at least k of the runs
+	ks, tp, fp = revealed_by_at_least(pack_runs(preds), mem)
+	for k in ks:
+		print("%d or more" % k if k < ks[-1] else "exactly %d" % k)
+		print(tp[k], fp[k], tp[k] / (tp[k] + fp[k]))
 
 def generate_venn(mem, preds):
-	run1 = preds[0]
-	run2 = preds[1]
-
-	run1_tp = []
-	run1_fp = []
-	run2_tp = []
-	run2_fp = []
-	bothpos = []
-	bothtruepos = []
-
-	for index in range(len(mem)):
-		if mem[index] == 0:
-			if run1[index] == 1:
-				run1_fp += [index]
-			if run2[index] == 1:
-				run2_fp += [index]
-		else:  # mem(index) == 0
-			if run1[index] == 1:
-				run1_tp += [index]
-			if run2[index] == 1:
-				run2_tp += [index]
-
-	run1pos = run1_fp + run1_tp
-	run2pos = run2_fp + run2_tp
-
-	for mem in run1pos:
-		if mem in run2pos:
-			bothpos += [mem]
-	for mem in run1_tp:
-		if mem in run2_tp:
-			bothtruepos += [mem]
-
-	s1 = len(run1_fp)
-	s2 = len(run2_fp)
-	s3 = len(bothpos) - len(bothtruepos)
-	s4 = 0
-	s5 = len(run1_tp)
-	s6 = len(run2_tp)
-	s7 = len(bothtruepos)
-
-	venn3(subsets=(s1,s2,s3,s4,s5,s6,s7), set_labels=("Run 1", "Run 2", "TP"))
+	# members (TP) and non-members (FP) revealed by exactly each combination of runs
+	member_regions, non_member_regions = run_region_counts(pack_runs(preds), mem)
+	for subset in range(1, len(member_regions)):
+		runs = [str(run + 1) for run in range(len(preds)) if subset >> run & 1]
+		print('Runs %s: TP %d, FP %d' % (', '.join(runs), member_regions[subset], non_member_regions[subset]))
+
+	# the diagram shows the first two runs
+	member_regions, non_member_regions = run_region_counts(pack_runs(preds[:2]), mem)
+	from matplotlib_venn import venn3
+	setup_plots()
+	venn3(subsets=(non_member_regions[1], non_member_regions[2], non_member_regions[3], 0, member_regions[1], member_regions[2], member_regions[3]), set_labels=("Run 1", "Run 2", "TP"))
 	plt.text(-0.70, 0.30, "FP")
 	plt.text(0.61, 0.30, "FP")
-	plt.show()
+	show_figure('venn')
 
 
-def members_revealed_fixed_threshold(result):
-	_, _, train_loss, membership, shokri_mem_adv, shokri_mem_confidence, yeom_mem_adv, per_instance_loss, yeom_attr_adv, per_instance_loss_all, _ = pickle.load(open(DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'.p', 'rb'))
+def members_revealed_fixed_threshold(result, venn=False):
+	_, _, train_loss, membership, shokri_mem_adv, shokri_mem_confidence, yeom_mem_adv, per_instance_loss, yeom_attr_adv, per_instance_loss_all, _ = load_result(no_privacy_file())
 	print(shokri_mem_adv, yeom_mem_adv, np.mean(yeom_attr_adv))
 	pred = np.where(per_instance_loss > train_loss, 0, 1)
 	#pred = np.where(shokri_mem_confidence[:,1] <= 0.5, 0, 1)
 	#attr_pred = np.array(per_instance_loss_all)
 	#pred = np.where(stats.norm(0, train_loss).pdf(attr_pred[:,0,:]) >= stats.norm(0, train_loss).pdf(attr_pred[:,1,:]), 0, 1).ravel()
-	tn, fp, fn, tp = confusion_matrix(membership, pred).ravel()
+	tn, fp, fn, tp = metrics.confusion_matrix(membership, pred).ravel()
 	print(tp, tp / (tp + fp))
-	fpr, tpr, thresholds = roc_curve(membership, pred, pos_label=1)
+	fpr, tpr, thresholds = metrics.roc_curve(membership, pred, pos_label=1)
 	print(fpr, tpr, np.max(tpr-fpr))
 	
 	for dp in DP:
 		for eps in EPSILONS:
-			ppv, preds = [], []
+			preds = []
 			for run in RUNS:
 				_, _, train_loss, membership, _, shokri_mem_confidence, _, per_instance_loss, _, per_instance_loss_all, _ = result[dp][eps][run]
 				pred = np.where(per_instance_loss > train_loss, 0, 1)
 				preds.append(pred)				
+				if args.bootstrap:
+					print_bootstrap_metrics('%s %s run %d' % (dp, eps, run + 1), bootstrap_metrics(membership, pred, args.bootstrap))
 				#pred = np.where(shokri_mem_confidence[:,1] <= 0.5, 0, 1)
 				#attr_pred = np.array(per_instance_loss_all)
 				#pred = np.where(stats.norm(0, train_loss).pdf(attr_pred[:,0,:]) >= stats.norm(0, train_loss).pdf(attr_pred[:,1,:]), 0, 1).ravel()
-				ppv.append(get_ppv(membership, pred))
-			print(dp, eps, np.mean(ppv))
-			sumpreds = np.sum(np.array(preds), axis=0)
-			ppv_across_runs(membership, sumpreds)
+			tp, fp, fn, tn = batch_confusion_counts(membership, preds)
+			print(dp, eps, np.mean(tp / (tp + fp)))
+			ppv_across_runs(membership, preds)
 
-	if args.venn == 1:
+	if venn:
 		generate_venn(membership, preds)
 
 
+def render_tasks():
+	# every figure and table, all of which are drawn from all the result files
+	files = [no_privacy_file()] + [result_file(dp, eps, run) for dp in DP for eps in EPSILONS for run in RUNS]
+	tasks = [('advantage_' + plot, plot_advantage, (plot,), files) for plot in ['acc', 'shokri_mi', 'yeom_mi', 'yeom_ai']]
+	tasks.append(('members_revealed_fixed_fpr', members_revealed_fixed_fpr, (), files))
+	tasks.append(('members_revealed_fixed_threshold', members_revealed_fixed_threshold, (True,), files))
+	return tasks
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('dataset', type=str)
@@ -254,16 +230,29 @@ if __name__ == '__main__':
 	parser.add_argument('--fpr_threshold', type=float, default=0.01)
 	parser.add_argument('--silent', type=int, default=1)
 	parser.add_argument('--venn', type=int, default=0)
+	# bootstrap resamples for the per-run confidence intervals of the attack metrics (0 disables them)
+	parser.add_argument('--bootstrap', type=int, default=0)
+	parser.add_argument('--render_all', type=int, default=0)
+	parser.add_argument('--out_dir', type=str, default=None)
+	parser.add_argument('--workers', type=int, default=0)
 	args = parser.parse_args()
 	print(vars(args))
 
 	DATA_PATH = '../results/' + str(args.dataset) + '/'
 	MODEL = str(args.model) + '_'
 
+	if args.render_all:
+		setup_plots()
+		# the options that select a single plot do not change the rendered figures
+		settings = {k: v for k, v in vars(args).items() if k not in ['function', 'plot', 'venn', 'render_all', 'out_dir', 'workers']}
+		failed = render_figures(render_tasks(), get_data, args.out_dir or './figures/' + str(args.dataset) + '/', args.workers, settings, [__file__])
+		sys.exit(1 if failed else 0)
+
 	result = get_data()
 	if args.function == 1:
-		plot_advantage(result) # plot the utility and privacy loss graphs
+		setup_plots()
+		plot_advantage(result, args.plot) # plot the utility and privacy loss graphs
 	elif args.function == 2:
 		members_revealed_fixed_fpr(result) # return the number of members revealed for different FPR rates
 	else:
-		members_revealed_fixed_threshold(result)
+		members_revealed_fixed_threshold(result, args.venn == 1)
@@ -26,17 +26,28 @@ pip install git+git://github.com/tensorflow/privacy@master
 echo "Filling data/ directory"
 python $CODE $DATASET --save_data=1
 
+# baseline hyperparameters, replaced by those chosen by hyperparameter_search.py when it has been run, e.g.
+# python hyperparameter_search.py $DATASET --target_model=nn
+SOFTMAX_ARGS="--target_model=softmax --target_l2_ratio=1e-5"
+NN_ARGS="--target_model=nn --target_l2_ratio=1e-4"
+if [ -f results/$DATASET/hyperparameters_softmax.args ]; then
+    SOFTMAX_ARGS=$(cat results/$DATASET/hyperparameters_softmax.args)
+fi
+if [ -f results/$DATASET/hyperparameters_nn.args ]; then
+    NN_ARGS=$(cat results/$DATASET/hyperparameters_nn.args)
+fi
+
 echo "Beginning experiment"
-python $CODE $DATASET --target_model='softmax' --target_l2_ratio=1e-5
-python $CODE $DATASET --target_model='nn' --target_l2_ratio=1e-4
+python $CODE $DATASET $SOFTMAX_ARGS
+python $CODE $DATASET $NN_ARGS
 for RUN in 1 2 3 4 5
 do
     for EPSILON in 0.1 0.5 1.0 5.0 10.0 50.0 100.0 500.0 1000.0
     do
         for DP in 'dp' 'adv_cmp' 'rdp' 'zcdp'
         do
-            python $CODE $DATASET --target_model='softmax' --target_l2_ratio=1e-5 --target_privacy='grad_pert' --target_dp=$DP --target_epsilon=$EPSILON --run=$RUN
-            python $CODE $DATASET --target_model='nn' --target_l2_ratio=1e-4 --target_privacy='grad_pert' --target_dp=$DP --target_epsilon=$EPSILON --run=$RUN
+            python $CODE $DATASET $SOFTMAX_ARGS --target_privacy='grad_pert' --target_dp=$DP --target_epsilon=$EPSILON --run=$RUN
+            python $CODE $DATASET $NN_ARGS --target_privacy='grad_pert' --target_dp=$DP --target_epsilon=$EPSILON --run=$RUN
         done
     done
 done
@@ -0,0 +1,47 @@
+from constants import SEED
+import numpy as np
+import argparse
+import pickle
+import os
+
+# records are generated in chunks to bound the float64 temporaries
+CHUNK_SIZE = 100000
+
+def make_synthetic_dataset(n, n_features, n_classes, sparsity=0.0, separability=1.0, seed=SEED):
+    # Each class is a gaussian cluster around a random centroid. separability scales the
+    # distance between centroids relative to the within-class noise, and sparsity is the
+    # fraction of features zeroed in each record. Records are L2 normalized.
+    rng = np.random.RandomState(seed)
+    centroids = separability * rng.normal(size=(n_classes, n_features))
+    # balanced classes, so that the stratified splits of save_data succeed
+    y = rng.permutation(np.arange(n) % n_classes).astype(np.int32)
+    x = np.empty((n, n_features), dtype=np.float32)
+    for start in range(0, n, CHUNK_SIZE):
+        y_chunk = y[start:start + CHUNK_SIZE]
+        chunk = centroids[y_chunk] + rng.normal(size=(len(y_chunk), n_features))
+        if sparsity > 0:
+            chunk[rng.uniform(size=chunk.shape) < sparsity] = 0
+        norms = np.linalg.norm(chunk, axis=1)
+        norms[norms == 0] = 1
+        x[start:start + CHUNK_SIZE] = chunk / norms[:, np.newaxis]
+    return x, y
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', type=str)
+    parser.add_argument('--n', type=int, default=int(1e5))
+    parser.add_argument('--n_features', type=int, default=600)
+    parser.add_argument('--n_classes', type=int, default=100)
+    parser.add_argument('--sparsity', type=float, default=0.0)
+    parser.add_argument('--separability', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+    print(vars(args))
+
+    x, y = make_synthetic_dataset(args.n, args.n_features, args.n_classes, args.sparsity, args.separability, args.seed)
+    print(x.shape, y.shape)
+    # same format as the pre-processed data sets read by save_data
+    if not os.path.exists('dataset'):
+        os.makedirs('dataset')
+    pickle.dump(x, open('dataset/'+args.dataset+'_features.p', 'wb'), protocol=4)
+    pickle.dump(y, open('dataset/'+args.dataset+'_labels.p', 'wb'), protocol=4)
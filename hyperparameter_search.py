@@ -0,0 +1,101 @@
+import attack
+import evaluating_dpml
+from attack import load_data
+from utilities import log_loss, lazy_import
+from constants import rdp_noise_multiplier, gdp_noise_multiplier
+import multiprocessing
+import numpy as np
+import itertools
+import argparse
+import json
+import math
+import os
+
+# TensorFlow is only imported by the worker processes
+models = lazy_import('classifier')
+
+
+def get_budgets(min_epochs, max_epochs, eta):
+    # epochs of each rung of successive halving, growing by eta up to max_epochs
+    n_rungs = 1 + int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+    return [min_epochs * eta ** r for r in range(n_rungs - 1)] + [max_epochs]
+
+
+def get_candidates(args):
+    # the hidden size only matters for the nn model
+    n_hiddens = args.n_hiddens if args.target_model == 'nn' else [args.target_n_hidden]
+    return [{'l2_ratio': l2_ratio, 'learning_rate': learning_rate, 'n_hidden': n_hidden}
+            for l2_ratio, learning_rate, n_hidden in itertools.product(args.l2_ratios, args.learning_rates, n_hiddens)]
+
+
+def init_worker(args, threads):
+    global _args
+    _args = args
+    models.configure_threads(threads, min(2, threads))
+    attack.DATA_CACHE = {}
+
+
+def evaluate_candidate(task):
+    # trains a candidate for the given epochs on the train split of shadow0, and scores it on the
+    # test split, so that the target model's records play no part in the choice
+    candidate, epochs = task
+    train_x, train_y, test_x, test_y = load_data('shadow0_data.npz', _args)
+    with models.model_storage():
+        classifier = models.train((train_x, train_y, test_x, test_y), n_hidden=candidate['n_hidden'], epochs=epochs, learning_rate=candidate['learning_rate'], batch_size=_args.target_batch_size, model=_args.target_model, l2_ratio=candidate['l2_ratio'], solver=_args.target_solver)
+        pred_y, pred_scores = models.predict(classifier, test_x)
+    return dict(candidate, epochs=epochs, loss=float(np.mean(log_loss(test_y, pred_scores))), acc=float(np.mean(pred_y == test_y)))
+
+
+def successive_halving(args, candidates, budgets):
+    # Every rung trains the remaining candidates for its budget of epochs, in parallel, and keeps
+    # the best 1/eta of them by validation accuracy (then loss) for the next rung
+    workers = args.workers or len(os.sched_getaffinity(0))
+    threads = max(1, len(os.sched_getaffinity(0)) // workers)
+    history = []
+    # spawned workers, as TensorFlow does not survive a fork
+    with multiprocessing.get_context('spawn').Pool(workers, initializer=init_worker, initargs=(args, threads)) as pool:
+        for rung, epochs in enumerate(budgets):
+            print('-' * 10 + 'RUNG %d: %d CANDIDATES FOR %d EPOCHS' % (rung, len(candidates), epochs) + '-' * 10)
+            results = sorted(pool.map(evaluate_candidate, [(c, epochs) for c in candidates]), key=lambda r: (-r['acc'], r['loss']))
+            for r in results:
+                print('l2_ratio %g, learning_rate %g, n_hidden %d: accuracy %.4f, loss %.4f' % (r['l2_ratio'], r['learning_rate'], r['n_hidden'], r['acc'], r['loss']))
+            history.append(results)
+            candidates = [{k: r[k] for k in ['l2_ratio', 'learning_rate', 'n_hidden']} for r in results[:max(1, int(math.ceil(len(results) / args.eta)))]]
+    return results[0], history
+
+
+if __name__ == '__main__':
+    # the remaining arguments are those of evaluating_dpml.py that select the data and fixed settings
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--l2_ratios', type=float, nargs='+', default=[1e-8, 1e-6, 1e-5, 1e-4, 1e-3])
+    parser.add_argument('--learning_rates', type=float, nargs='+', default=[0.001, 0.005, 0.01])
+    parser.add_argument('--n_hiddens', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--min_epochs', type=int, default=10)
+    parser.add_argument('--max_epochs', type=int, default=100)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    search_args, driver_args = parser.parse_known_args()
+    # the chosen --target_epochs is also used by the private runs, whose rdp and gdp noise is
+    # only tabulated for some numbers of epochs
+    if search_args.max_epochs not in rdp_noise_multiplier or search_args.max_epochs not in gdp_noise_multiplier:
+        parser.error('--max_epochs must be one of %s, the epochs of the noise multiplier tables in constants.py' % ', '.join(str(e) for e in sorted(set(rdp_noise_multiplier) & set(gdp_noise_multiplier))))
+    args = evaluating_dpml.get_parser().parse_args(driver_args)
+    for k, v in vars(search_args).items():
+        setattr(args, k, v)
+    print(vars(args))
+
+    budgets = get_budgets(args.min_epochs, args.max_epochs, args.eta)
+    best, history = successive_halving(args, get_candidates(args), budgets)
+    print('-' * 10 + 'CHOSEN HYPERPARAMETERS' + '-' * 10)
+    print(best)
+
+    output = args.output or evaluating_dpml.RESULT_PATH + args.train_dataset + '/hyperparameters_' + args.target_model
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output + '.json', 'w') as f:
+        json.dump({'config': vars(args), 'budgets': budgets, 'best': best, 'rungs': history}, f, indent=2)
+    # the arguments of the chosen baseline, read by evaluating_dpml_run.sh
+    with open(output + '.args', 'w') as f:
+        f.write('--target_model=%s --target_l2_ratio=%g --target_learning_rate=%g --target_n_hidden=%d --target_epochs=%d\n' % (args.target_model, best['l2_ratio'], best['learning_rate'], best['n_hidden'], best['epochs']))
+    print('Results written to %s.json and %s.args' % (output, output))
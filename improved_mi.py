@@ -1,17 +1,54 @@
-from attack import save_data, load_data, train_target_model, yeom_membership_inference, shokri_membership_inference, proposed_membership_inference, evaluate_proposed_membership_inference
-from utilities import log_loss, get_random_features
+from attack import MODEL_PATH, save_data, load_data, train_target_model, yeom_membership_inference, shokri_membership_inference, proposed_membership_inference, evaluate_proposed_membership_inference
+from utilities import save_result, log_loss, get_random_features, claim_cpu_partition, profile_phase, start_phase_profile, save_phase_profile, open_phase_checkpoints, run_phase, clear_phase_checkpoints, PHASE_CHECKPOINT_SUBDIR, lazy_import
 import numpy as np
 import argparse
 import os
-import pickle
+
+# TensorFlow is not imported when only the data is being prepared
+models = lazy_import('classifier')
 
 RESULT_PATH = 'results/'
 
 if not os.path.exists(RESULT_PATH):
     os.makedirs(RESULT_PATH)
 
+def get_result_path(args):
+    if args.target_privacy == 'no_privacy':
+        return RESULT_PATH+args.train_dataset+'/'+str(args.target_test_train_ratio)+'_'+args.target_model+'_'+args.target_privacy+'_'+str(args.target_l2_ratio)+'_'+str(args.run)+'.p'
+    return RESULT_PATH+args.train_dataset+'/'+str(args.target_test_train_ratio)+'_'+args.target_model+'_'+args.target_privacy+'_'+args.target_dp+'_'+str(args.target_epsilon)+'_'+str(args.run)+'.p'
+
+def get_export_dir(args):
+    # exported models are keyed by the same configuration as the result file
+    return MODEL_PATH+args.train_dataset+'/'+os.path.splitext(os.path.basename(get_result_path(args)))[0]+'/'
+
+def get_trajectory_epochs(args):
+    # epochs after which the per-example losses of the target model are recorded
+    return [int(epoch) for epoch in args.trajectory_epochs.split(',')] if args.trajectory_epochs else None
+
+def check_args(args):
+    # options that would otherwise only fail, or be ignored, once training has started
+    try:
+        trajectory_epochs = get_trajectory_epochs(args) or []
+    except ValueError:
+        return '--trajectory_epochs must be a comma-separated list of epochs, not ' + args.trajectory_epochs
+    if not all(1 <= epoch <= args.target_epochs for epoch in trajectory_epochs):
+        # the rows of the epochs that are never reached would be left as zeros
+        return '--trajectory_epochs must be between 1 and --target_epochs (%d), not %s' % (args.target_epochs, args.trajectory_epochs)
+    if not 1 <= args.n_reference <= args.n_shadow:
+        return '--n_reference must be between 1 and --n_shadow (%d), not %d' % (args.n_shadow, args.n_reference)
+    return None
+
 def run_experiment(args):
+    if check_args(args):
+        raise ValueError(check_args(args))
     print('-' * 10 + 'TRAIN TARGET' + '-' * 10 + '\n')
+    # phase checkpoints are kept with the exported models of the experiment; without
+    # --export_models, in a subdirectory of their own that leaves earlier exports alone
+    export_dir = get_export_dir(args) if args.export_models else (get_export_dir(args) + PHASE_CHECKPOINT_SUBDIR if args.checkpoint_phases else None)
+    checkpoint_dir = export_dir if args.checkpoint_phases else None
+    if export_dir is not None and not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    open_phase_checkpoints(checkpoint_dir, args)
     dataset = load_data('target_data.npz', args)
     v_dataset = load_data('shadow0_data.npz', args)
     train_x, train_y, test_x, test_y = dataset
@@ -19,21 +56,38 @@ def run_experiment(args):
     true_y = np.append(train_y, test_y)
     batch_size = args.target_batch_size
 
-    pred_y, membership, test_classes, classifier, aux = train_target_model(
-        args=args,
-        dataset=dataset,
-        epochs=args.target_epochs,
-        batch_size=args.target_batch_size,
-        learning_rate=args.target_learning_rate,
-        clipping_threshold=args.target_clipping_threshold,
-        n_hidden=args.target_n_hidden,
-        l2_ratio=args.target_l2_ratio,
-        model=args.target_model,
-        privacy=args.target_privacy,
-        dp=args.target_dp,
-        epsilon=args.target_epsilon,
-        delta=args.target_delta,
-        save=args.save_model)
+    classifier = None
+    def target_training():
+        nonlocal classifier
+        # only profiled when the model is trained, not when a completed phase is resumed
+        with profile_phase('target_training', len(train_x) * args.target_epochs):
+            pred_y, membership, test_classes, classifier, aux = train_target_model(
+                args=args,
+                dataset=dataset,
+                epochs=args.target_epochs,
+                batch_size=args.target_batch_size,
+                learning_rate=args.target_learning_rate,
+                clipping_threshold=args.target_clipping_threshold,
+                n_hidden=args.target_n_hidden,
+                l2_ratio=args.target_l2_ratio,
+                model=args.target_model,
+                privacy=args.target_privacy,
+                dp=args.target_dp,
+                epsilon=args.target_epsilon,
+                delta=args.target_delta,
+                dp_optimizer_impl=args.target_dp_optimizer,
+                save=args.save_model,
+                model_dir=MODEL_PATH + 'target_model/' if args.save_model else None,
+                solver=args.target_solver,
+                trajectory_epochs=get_trajectory_epochs(args),
+                trajectory_path=os.path.splitext(get_result_path(args))[0] + '_trajectory.npy',
+                export_path=export_dir + 'target.npz' if export_dir is not None else None)
+        return pred_y, membership, test_classes, aux
+
+    pred_y, membership, test_classes, aux = run_phase(checkpoint_dir, 'target_training', target_training)
+    if classifier is None:
+        # the target model was trained before the run was restarted
+        classifier, _ = models.load_model(export_dir + 'target.npz')
     train_loss, train_acc, test_loss, test_acc = aux
     per_instance_loss = np.array(log_loss(true_y, pred_y))
    
@@ -43,28 +97,33 @@ def run_experiment(args):
     yeom_mi_outputs_2 = yeom_membership_inference(per_instance_loss, membership, train_loss, test_loss)
 
     # Shokri's membership inference attack
-    shokri_mi_outputs = shokri_membership_inference(args, pred_y, membership, test_classes)
+    shokri_mi_outputs = run_phase(checkpoint_dir, 'shokri', lambda: shokri_membership_inference(args, pred_y, membership, test_classes, export_dir=export_dir))
 
     # Proposed membership inference attacks
-    proposed_mi_outputs = proposed_membership_inference(v_dataset, true_x, true_y, classifier, per_instance_loss, args)
+    # reference models trained before the run was restarted are not trained again
+    proposed_mi_outputs = run_phase(checkpoint_dir, 'merlin', lambda: proposed_membership_inference(v_dataset, true_x, true_y, classifier, per_instance_loss, args, export_dir=export_dir, import_dir=checkpoint_dir))
     evaluate_proposed_membership_inference(per_instance_loss, membership, proposed_mi_outputs, fpr_threshold=0.01)
     evaluate_proposed_membership_inference(per_instance_loss, membership, proposed_mi_outputs, fpr_threshold=0.01, per_class_thresh=True)
 
     if not os.path.exists(RESULT_PATH+args.train_dataset):
         os.makedirs(RESULT_PATH+args.train_dataset)
     
-    if args.target_privacy == 'no_privacy':
-        pickle.dump([aux, membership, per_instance_loss, yeom_mi_outputs_1, yeom_mi_outputs_2, shokri_mi_outputs, proposed_mi_outputs], open(RESULT_PATH+args.train_dataset+'/'+str(args.target_test_train_ratio)+'_'+args.target_model+'_'+args.target_privacy+'_'+str(args.target_l2_ratio)+'_'+str(args.run)+'.p', 'wb'))	
-    else:
-        pickle.dump([aux, membership, per_instance_loss, yeom_mi_outputs_1, yeom_mi_outputs_2, shokri_mi_outputs, proposed_mi_outputs], open(RESULT_PATH+args.train_dataset+'/'+str(args.target_test_train_ratio)+'_'+args.target_model+'_'+args.target_privacy+'_'+args.target_dp+'_'+str(args.target_epsilon)+'_'+str(args.run)+'.p', 'wb'))
+    save_result([aux, membership, per_instance_loss, yeom_mi_outputs_1, yeom_mi_outputs_2, shokri_mi_outputs, proposed_mi_outputs], get_result_path(args), compress=args.compact_scores)
+    clear_phase_checkpoints(checkpoint_dir, keep_models=args.export_models)
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('train_dataset', type=str)
     parser.add_argument('--run', type=int, default=1)
     parser.add_argument('--use_cpu', type=int, default=0)
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--cpu_partitions', type=int, default=0)
     parser.add_argument('--save_model', type=int, default=0)
+    parser.add_argument('--export_models', type=int, default=0)
     parser.add_argument('--save_data', type=int, default=0)
+    parser.add_argument('--profile_phases', type=int, default=0)
+    parser.add_argument('--checkpoint_phases', type=int, default=0)
     # target and shadow model configuration
     parser.add_argument('--n_shadow', type=int, default=5)
     parser.add_argument('--target_data_size', type=int, default=int(1e4))
@@ -80,6 +139,11 @@ if __name__ == '__main__':
     parser.add_argument('--target_dp', type=str, default='dp')
     parser.add_argument('--target_epsilon', type=float, default=0.5)
     parser.add_argument('--target_delta', type=float, default=1e-5)
+    parser.add_argument('--target_dp_optimizer', type=str, default='microbatch', choices=['vectorized', 'microbatch'])
+    # 'lbfgs' fits the softmax model without privacy by full-batch L-BFGS instead of Adam
+    parser.add_argument('--target_solver', type=str, default='adam', choices=['adam', 'lbfgs'])
+    # comma-separated epochs after which the per-example losses of the target model are recorded, e.g. 1,10,100
+    parser.add_argument('--trajectory_epochs', type=str, default='')
     # attack model configuration
     parser.add_argument('--attack_model', type=str, default='nn')
     parser.add_argument('--attack_learning_rate', type=float, default=0.01)
@@ -87,13 +151,26 @@ if __name__ == '__main__':
     parser.add_argument('--attack_n_hidden', type=int, default=64)
     parser.add_argument('--attack_epochs', type=int, default=100)
     parser.add_argument('--attack_l2_ratio', type=float, default=1e-6)
+    parser.add_argument('--attack_backend', type=str, default='tf', choices=['tf', 'numpy'])
+    # keep only the top k sorted scores for Shokri's attack, in half precision, and compress the result file (0 keeps all)
+    parser.add_argument('--compact_scores', type=int, default=0)
+    # train all the shadow models at once as one stacked model, for the nn and softmax models without privacy
+    parser.add_argument('--stacked_shadow', type=int, default=0)
     # proposed attack's noise parameters
     parser.add_argument('--attack_noise_type', type=str, default='gaussian')
     parser.add_argument('--attack_noise_coverage', type=str, default='full')
     parser.add_argument('--attack_noise_magnitude', type=float, default=0.01)
+    parser.add_argument('--attack_noise_bank', type=int, default=0)
+    # reference models for the proposed attack's thresholds, trained on the first n_reference shadow splits
+    parser.add_argument('--n_reference', type=int, default=1)
+    return parser
 
+if __name__ == '__main__':
     # parse configuration
+    parser = get_parser()
     args = parser.parse_args()
+    if check_args(args):
+        parser.error(check_args(args))
     print(vars(args))
     
     # Flag to disable GPU
@@ -103,4 +180,19 @@ if __name__ == '__main__':
     if args.save_data:
         save_data(args)
     else:
-        run_experiment(args)
+        # Split the node's cores among this many co-located experiments and size the thread pools to this process's share
+        if args.cpu_partitions:
+            cores = claim_cpu_partition(args.cpu_partitions)
+            args.intra_op_threads = args.intra_op_threads or len(cores)
+            args.inter_op_threads = args.inter_op_threads or min(2, len(cores))
+        models.configure_threads(args.intra_op_threads, args.inter_op_threads)
+        if args.profile_phases:
+            start_phase_profile()
+        # transient models are kept in RAM-backed storage that is cleaned up
+        # when the experiment finishes or fails
+        try:
+            with models.model_storage():
+                run_experiment(args)
+        finally:
+            # per-phase timings are written next to the result file, including those of a failed run
+            save_phase_profile(os.path.splitext(get_result_path(args))[0] + '_phases.json')
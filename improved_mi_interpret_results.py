@@ -1,9 +1,11 @@
-from sklearn.metrics import roc_curve
-from utilities import get_fp, get_adv, get_ppv, get_inference_threshold, plot_histogram, plot_sign_histogram
-import matplotlib.pyplot as plt
+from utilities import load_result, bootstrap_metrics, print_bootstrap_metrics, get_fp, get_adv, get_ppv, get_inference_threshold, search_morgan_thresholds, plot_histogram, plot_sign_histogram, lazy_import, show_figure, render_figures
 import numpy as np
-import pickle
 import argparse
+import sys
+
+# matplotlib and sklearn are imported on first use
+metrics = lazy_import('sklearn.metrics')
+plt = lazy_import('matplotlib.pyplot')
 
 
 EPS = list(np.arange(0.1, 100, 0.01))
@@ -18,16 +20,17 @@ A, B = len(EPSILONS), len(RUNS)
 ALPHAS = np.arange(0.01, 1, 0.01)
 delta = 1e-5
 
-frame = plt.rcParams['figure.figsize']
-new_rc_params = {
-	'figure.figsize': [frame[0], 0.8*frame[1]],
-	'font.size': 22, # 18 (20) default, changed to 22
-	'text.usetex': True,
-	'font.family': 'Times New Roman',
-	'mathtext.fontset': 'stix',
-	'xtick.major.pad': '8'
-}
-plt.rcParams.update(new_rc_params)
+def setup_plots():
+	frame = plt.rcParams['figure.figsize']
+	new_rc_params = {
+		'figure.figsize': [frame[0], 0.8*frame[1]],
+		'font.size': 22, # 18 (20) default, changed to 22
+		'text.usetex': True,
+		'font.family': 'Times New Roman',
+		'mathtext.fontset': 'stix',
+		'xtick.major.pad': '8'
+	}
+	plt.rcParams.update(new_rc_params)
 
 def f(eps, delta, alpha):
 	return max(0, 1 - delta - np.exp(eps) * alpha, np.exp(-eps) * (1 - delta - alpha))
@@ -44,6 +47,11 @@ def improved_limit(epsilons):
 def yeoms_limit(epsilons):
 	return [np.exp(eps) - 1 for eps in epsilons]
 
+def result_file(dp, eps, run):
+	if dp == 'no_privacy':
+		return DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'_'+str(run+1)+'.p'
+	return DATA_PATH+MODEL+PERTURBATION+dp+str(eps)+'_'+str(run+1)+'.p'
+
 def get_data():
 	result = {}
 	for dp in DP:
@@ -51,12 +59,12 @@ def get_data():
 		for eps in EPSILONS:
 			runs = {}
 			for run in RUNS:
-				runs[run] = list(pickle.load(open(DATA_PATH+MODEL+PERTURBATION+dp+str(eps)+'_'+str(run+1)+'.p', 'rb')))
+				runs[run] = list(load_result(result_file(dp, eps, run)))
 			epsilons[eps] = runs
 		result[dp] = epsilons
 	runs = {}
 	for run in RUNS:
-		runs[run] = list(pickle.load(open(DATA_PATH+MODEL+'no_privacy_'+str(args.l2_ratio)+'_'+str(run+1)+'.p', 'rb')))
+		runs[run] = list(load_result(result_file('no_privacy', None, run)))
 	result['no_privacy'] = runs
 	return result
 
@@ -133,8 +141,8 @@ def get_pred_mem_mi(per_instance_loss, shokri_mi_outputs, proposed_mi_outputs, m
 			thresh = get_inference_threshold(v_counts, v_membership, fpr_threshold)
 			return thresh, np.where(counts >= thresh, 1, 0)
 
-def plot_distributions(pred_vector, true_vector, method='yeom'):
-	fpr, tpr, phi = roc_curve(true_vector, pred_vector, pos_label=1)
+def plot_distributions(pred_vector, true_vector, method='yeom', name='distributions'):
+	fpr, tpr, phi = metrics.roc_curve(true_vector, pred_vector, pos_label=1)
 	fpr, tpr, phi = np.array(fpr), np.array(tpr), np.array(phi)
 	if method == 'yeom':
 		fpr = 1 - fpr
@@ -170,7 +178,7 @@ def plot_distributions(pred_vector, true_vector, method='yeom'):
 	ax1.set_ylim(0, 1)
 	#ax2.set_yticks(np.arange(0, 1.1, step=0.2))
 	fig.tight_layout()
-	plt.show()
+	show_figure(name)
 
 def get_zeros(mem, vect):
 	ind = list(filter(lambda i: vect[i] == 0, list(range(len(vect)))))
@@ -204,10 +212,13 @@ def plot_accuracy(result):
 	plt.ylabel('Accuracy Loss')
 	plt.yticks(np.arange(0, 1.1, step=0.2))
 	plt.xticks(EPSILONS)
-	plt.annotate("RDP", pretty_position(EPSILONS, y["rdp_"], 1), textcoords="offset points", xytext=(20, 10), ha='right', color=str(0.3))
-	plt.annotate("GDP", pretty_position(EPSILONS, y["gdp_"], 1), textcoords="offset points", xytext=(-50, -10), ha='right', color=str(0.1))
+	# only the notions in DP are plotted
+	if 'rdp_' in y:
+		plt.annotate("RDP", pretty_position(EPSILONS, y["rdp_"], 1), textcoords="offset points", xytext=(20, 10), ha='right', color=str(0.3))
+	if 'gdp_' in y:
+		plt.annotate("GDP", pretty_position(EPSILONS, y["gdp_"], 1), textcoords="offset points", xytext=(-50, -10), ha='right', color=str(0.1))
 	plt.tight_layout()
-	plt.show()
+	show_figure('accuracy')
 
 def plot_privacy_leakage(result, eps=None, dp='gdp_'):
 	adv_yeom_vanilla_1, adv_yeom, adv_shokri, adv_merlin = np.zeros(B), np.zeros(B), np.zeros(B), np.zeros(B)
@@ -229,19 +240,25 @@ def plot_privacy_leakage(result, eps=None, dp='gdp_'):
 		#plot_histogram(per_instance_loss)
 		#plot_distributions(per_instance_loss, membership, method='yeom')
 		#plot_sign_histogram(membership, counts, 100)
-		plot_distributions(counts, membership, method='merlin')
+		plot_distributions(counts, membership, method='merlin', name='merlin_distributions_run%d' % (run + 1))
 		# As used below, method == 'yeom' runs a Yeom attack but finds a better threshold than is used in the original Yeom attack.
 		thresh, pred = get_pred_mem_mi(per_instance_loss, shokri_mi_outputs, proposed_mi_outputs, method='yeom', fpr_threshold=alpha, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
 		fp, adv, ppv = get_fp(membership, pred), get_adv(membership, pred), get_ppv(membership, pred)
 		thresh_yeom[run], fpr_yeom[run], adv_yeom[run], ppv_yeom[run] = thresh, fp / (gamma * 10000), adv, ppv
+		if args.bootstrap:
+			print_bootstrap_metrics('Yeom run %d' % (run + 1), bootstrap_metrics(membership, pred, args.bootstrap))
 		# As used below, method == 'shokri' runs a Shokri attack but finds a better threshold than is used in the original Yeom attack.
 		thresh, pred = get_pred_mem_mi(per_instance_loss, shokri_mi_outputs, proposed_mi_outputs, method='shokri', fpr_threshold=alpha, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
 		fp, adv, ppv = get_fp(target_membership, pred), get_adv(target_membership, pred), get_ppv(target_membership, pred)
 		thresh_shokri[run], fpr_shokri[run], adv_shokri[run], ppv_shokri[run] = thresh, fp / (args.gamma * 10000), adv, ppv
+		if args.bootstrap:
+			print_bootstrap_metrics('Shokri run %d' % (run + 1), bootstrap_metrics(target_membership, pred, args.bootstrap))
 		# As used below, method == 'merlin' runs a new threshold-based membership inference attack that uses the direction of the change in per-instance loss for the record.
 		thresh, pred = get_pred_mem_mi(per_instance_loss, shokri_mi_outputs, proposed_mi_outputs, method='merlin', fpr_threshold=alpha, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
 		fp, adv, ppv = get_fp(membership, pred), get_adv(membership, pred), get_ppv(membership, pred)
 		thresh_merlin[run], fpr_merlin[run], adv_merlin[run], ppv_merlin[run] = thresh, fp / (gamma * 10000), adv, ppv
+		if args.bootstrap:
+			print_bootstrap_metrics('Merlin run %d' % (run + 1), bootstrap_metrics(membership, pred, args.bootstrap))
 		# Original Yeom attack that uses expected training loss threshold
 		fp, adv, ppv = get_fp(membership, yeom_mi_outputs_1), get_adv(membership, yeom_mi_outputs_1), get_ppv(membership, yeom_mi_outputs_1)
 		thresh_yeom_vanilla_1[run], fpr_yeom_vanilla_1[run], adv_yeom_vanilla_1[run], ppv_yeom_vanilla_1[run] = train_loss, fp / (gamma * 10000), adv, ppv
@@ -252,15 +269,15 @@ def plot_privacy_leakage(result, eps=None, dp='gdp_'):
 	print('\nShokri:\nphi: %f +/- %f\nFPR: %.4f +/- %.4f\nTPR: %.4f +/- %.4f\nAdv: %.4f +/- %.4f\nPPV: %.4f +/- %.4f' % (np.mean(thresh_shokri), np.std(thresh_shokri), np.mean(fpr_shokri), np.std(fpr_shokri), np.mean(adv_shokri+fpr_shokri), np.std(adv_shokri+fpr_shokri), np.mean(adv_shokri), np.std(adv_shokri), np.mean(ppv_shokri), np.std(ppv_shokri)))
 	print('\nMerlin:\nphi: %f +/- %f\nFPR: %.4f +/- %.4f\nTPR: %.4f +/- %.4f\nAdv: %.4f +/- %.4f\nPPV: %.4f +/- %.4f' % (np.mean(thresh_merlin), np.std(thresh_merlin), np.mean(fpr_merlin), np.std(fpr_merlin), np.mean(adv_merlin+fpr_merlin), np.std(adv_merlin+fpr_merlin), np.mean(adv_merlin), np.std(adv_merlin), np.mean(ppv_merlin), np.std(ppv_merlin)))				
 
-def scatterplot(result):
-	morgan(result)
+def scatterplot(result, eps=None):
+	phi_l, phi_u, phi_m = morgan(result, eps)
 	for run in RUNS:
-		if args.eps == None:
+		if eps == None:
 			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['no_privacy'][run]
 		else:
-			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['gdp_'][args.eps][run]
+			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['gdp_'][eps][run]
 		_, _, _, _, _, counts = proposed_mi_outputs
-		counts /= 100
+		counts = counts / 100
 		axes = np.vstack((per_instance_loss, counts))
 		axes = np.vstack((membership, axes))
 		axes = np.transpose(axes)
@@ -278,10 +295,11 @@ def scatterplot(result):
 		# phi_l is lower threshold on loss
 		# phi_u is upper threshold on loss
 		# phi_m is threshold on merlin ratio
-		phi_l, phi_u, phi_m = 0.0001, 0.0015, 0.95
-		plt.plot([phi_l, phi_u], [phi_m, phi_m], c='k')
-		plt.plot([phi_l, phi_l], [phi_m, 1], c='k')
-		plt.plot([phi_u, phi_u], [phi_m, 1], c='k')
+		# the thresholds found by morgan for this run, where an unbounded phi_u is drawn at the largest loss
+		phi_u[run] = min(phi_u[run], np.max(per_instance_loss))
+		plt.plot([phi_l[run], phi_u[run]], [phi_m[run] / 100, phi_m[run] / 100], c='k')
+		plt.plot([phi_l[run], phi_l[run]], [phi_m[run] / 100, 1], c='k')
+		plt.plot([phi_u[run], phi_u[run]], [phi_m[run] / 100, 1], c='k')
 		plt.xscale('log')
 		plt.xticks([10 ** -8, 10 ** -6, 10 ** -4, 10 ** -2, 10 ** 0, 10 **2])
 		plt.yticks([0.0, 0.2, 0.4, 0.6, 0.8, 1.0])
@@ -289,28 +307,38 @@ def scatterplot(result):
 		plt.xlabel('Per-Instance Loss')
 		plt.ylabel('Merlin Ratio')
 		plt.tight_layout()
-		plt.show()
+		show_figure('scatter_run%d' % (run + 1))
 
-def morgan(result):
+def morgan(result, eps=None):
 	phi_l, phi_u, phi_m, fpr_morgan, adv_morgan, ppv_morgan = np.zeros(B), np.zeros(B), np.zeros(B), np.zeros(B), np.zeros(B), np.zeros(B)
-	alpha_l = 0.22 # alpha value used to tune lower loss threshold
-	alpha_u = 0.3 # alpha value used to tune upper loss threshold
 	for run in RUNS:
-		if args.eps == None:
+		if eps == None:
 			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['no_privacy'][run]
 		else:
-			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['gdp_'][args.eps][run]
+			_, membership, per_instance_loss, _, _, _, proposed_mi_outputs = result['gdp_'][eps][run]
 		true_y, v_true_y, v_membership, v_per_instance_loss, v_counts, counts = proposed_mi_outputs
-		low_thresh, _ = get_pred_mem_mi(per_instance_loss, proposed_mi_outputs, method='yeom', fpr_threshold=alpha_l, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
-		high_thresh, _ = get_pred_mem_mi(per_instance_loss, proposed_mi_outputs, method='yeom', fpr_threshold=alpha_u, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
-		merlin_thresh, _ = get_pred_mem_mi(per_instance_loss, proposed_mi_outputs, method='merlin', fpr_threshold=alpha, per_class_thresh=args.per_class_thresh, fixed_thresh=args.fixed_thresh)
+		# thresholds with the best advantage on the reference model at FPR <= alpha
+		low_thresh, high_thresh, merlin_thresh = search_morgan_thresholds(v_per_instance_loss, v_counts, v_membership, alpha, n_bins=args.morgan_bins)
 		pred_1 = np.where(per_instance_loss >= low_thresh, 1, 0)
-		pred_2 = np.where(per_instance_loss <= high_thresh, 1, 0)
+		pred_2 = np.where(per_instance_loss < high_thresh, 1, 0)
 		pred_3 = np.where(counts >= merlin_thresh, 1, 0)
 		pred = pred_1 & pred_2 & pred_3
 		fp, adv, ppv = get_fp(membership, pred), get_adv(membership, pred), get_ppv(membership, pred)
 		phi_l[run], phi_u[run], phi_m[run], fpr_morgan[run], adv_morgan[run], ppv_morgan[run] = low_thresh, high_thresh, merlin_thresh, fp / (gamma * 10000), adv, ppv
 	print('\nMorgan:\nphi: (%f +/- %f, %f +/- %f, %f +/- %f)\nFPR: %.4f +/- %.4f\nTPR: %.4f +/- %.4f\nAdv: %.4f +/- %.4f\nPPV: %.4f +/- %.4f' % (np.mean(phi_l), np.std(phi_l), np.mean(phi_u), np.std(phi_u), np.mean(phi_m), np.std(phi_m), np.mean(fpr_morgan), np.std(fpr_morgan), np.mean(adv_morgan+fpr_morgan), np.std(adv_morgan+fpr_morgan), np.mean(adv_morgan), np.std(adv_morgan), np.mean(ppv_morgan), np.std(ppv_morgan)))
+	return phi_l, phi_u, phi_m
+
+def render_tasks():
+	# every figure, with the result files it is drawn from
+	no_privacy = [result_file('no_privacy', None, run) for run in RUNS]
+	private = {eps: [result_file(dp, eps, run) for dp in DP for run in RUNS] for eps in EPSILONS}
+	tasks = [('accuracy', plot_accuracy, (), no_privacy + [f for eps in EPSILONS for f in private[eps]])]
+	tasks.append(('privacy_leakage_no_privacy', plot_privacy_leakage, (None,), no_privacy))
+	tasks.append(('scatter_no_privacy', scatterplot, (None,), no_privacy))
+	for eps in EPSILONS:
+		tasks.append(('privacy_leakage_eps_' + str(eps), plot_privacy_leakage, (eps,), private[eps]))
+		tasks.append(('scatter_eps_' + str(eps), scatterplot, (eps,), private[eps]))
+	return tasks
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
@@ -324,6 +352,12 @@ if __name__ == '__main__':
 	parser.add_argument('--plot', type=str, default='acc')
 	parser.add_argument('--eps', type=float, default=None)
 	parser.add_argument('--mem', type=str, default='all')
+	parser.add_argument('--morgan_bins', type=int, default=100)
+	# bootstrap resamples for the per-run confidence intervals of the attack metrics (0 disables them)
+	parser.add_argument('--bootstrap', type=int, default=0)
+	parser.add_argument('--render_all', type=int, default=0)
+	parser.add_argument('--out_dir', type=str, default=None)
+	parser.add_argument('--workers', type=int, default=0)
 	args = parser.parse_args()
 	print(vars(args))
 
@@ -332,10 +366,18 @@ if __name__ == '__main__':
 	DATA_PATH = './results/' + str(args.dataset) + '_improved_mi/'
 	MODEL = str(gamma) + '_' + str(args.model) + '_'
 
+	if args.render_all:
+		setup_plots()
+		# the options that select a single plot do not change the rendered figures
+		settings = {k: v for k, v in vars(args).items() if k not in ['plot', 'eps', 'render_all', 'out_dir', 'workers']}
+		failed = render_figures(render_tasks(), get_data, args.out_dir or './figures/' + str(args.dataset) + '_improved_mi/', args.workers, settings, [__file__])
+		sys.exit(1 if failed else 0)
+
 	result = get_data()
+	setup_plots()
 	if args.plot == 'acc':
 		plot_accuracy(result)
 	elif args.plot == 'scatter':
-		scatterplot(result)
+		scatterplot(result, args.eps)
 	else:
 		plot_privacy_leakage(result, args.eps)
@@ -0,0 +1,85 @@
+import evaluating_dpml
+import improved_mi
+from attack import reference_model_name, load_data, get_attack_data, yeom_membership_inference, shokri_membership_inference, proposed_membership_inference, evaluate_proposed_membership_inference, yeom_attribute_inference
+from classifier import load_model, model_storage, configure_threads
+from utilities import log_loss, get_random_features, save_result
+import numpy as np
+import argparse
+import sys
+import os
+
+DRIVERS = {'evaluating_dpml': evaluating_dpml, 'improved_mi': improved_mi}
+# the attacks each driver runs; only improved_mi trains reference models and has the Merlin settings
+ATTACKS = {'evaluating_dpml': ['yeom', 'shokri', 'attribute'], 'improved_mi': ['yeom', 'shokri', 'merlin', 'attribute']}
+
+
+def required_models(attacks, args):
+    # exported models each attack is run against, besides the target model
+    files = ['target.npz']
+    if 'shokri' in attacks:
+        files += ['shadow{}.npz'.format(i) for i in range(args.n_shadow)]
+    if 'merlin' in attacks:
+        files += [reference_model_name(i) for i in range(args.n_reference)]
+    return files
+
+
+def reattack(driver, args, attacks):
+    export_dir = driver.get_export_dir(args)
+    dataset = load_data('target_data.npz', args)
+    train_x, train_y, test_x, test_y = dataset
+    true_x = np.vstack((train_x, test_x))
+    true_y = np.append(train_y, test_y)
+
+    classifier, aux = load_model(export_dir + 'target.npz')
+    train_loss, train_acc, test_loss, test_acc = aux
+    pred_y, membership = get_attack_data(classifier, train_x, test_x)
+    test_classes = np.concatenate([train_y, test_y])
+    per_instance_loss = np.array(log_loss(true_y, pred_y))
+
+    outputs = {'aux': aux, 'membership': membership, 'per_instance_loss': per_instance_loss}
+    if 'yeom' in attacks:
+        outputs['yeom'] = (
+            yeom_membership_inference(per_instance_loss, membership, train_loss),
+            yeom_membership_inference(per_instance_loss, membership, train_loss, test_loss))
+    if 'shokri' in attacks:
+        outputs['shokri'] = shokri_membership_inference(args, pred_y, membership, test_classes, import_dir=export_dir)
+    if 'merlin' in attacks:
+        v_dataset = load_data('shadow0_data.npz', args)
+        outputs['merlin'] = proposed_membership_inference(v_dataset, true_x, true_y, classifier, per_instance_loss, args, import_dir=export_dir)
+        evaluate_proposed_membership_inference(per_instance_loss, membership, outputs['merlin'], fpr_threshold=0.01)
+    if 'attribute' in attacks:
+        features = get_random_features(true_x, range(true_x.shape[1]), 5)
+        outputs['attribute'] = (features, yeom_attribute_inference(true_x, true_y, classifier, membership, features, train_loss))
+
+    result_path = os.path.splitext(driver.get_result_path(args))[0] + '_reattack.p'
+    if not os.path.exists(os.path.dirname(result_path)):
+        os.makedirs(os.path.dirname(result_path))
+    save_result(outputs, result_path, compress=args.compact_scores)
+    print('Results written to ' + result_path)
+
+
+if __name__ == '__main__':
+    # the remaining arguments are those of the driver's command line that trained and exported the models
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--driver', type=str, default='improved_mi', choices=list(DRIVERS))
+    # defaults to all the attacks of the driver
+    parser.add_argument('--attacks', type=str, default=None)
+    reattack_args, driver_args = parser.parse_known_args()
+    driver = DRIVERS[reattack_args.driver]
+    attacks = reattack_args.attacks.split(',') if reattack_args.attacks else ATTACKS[reattack_args.driver]
+    for attack in attacks:
+        if attack not in ATTACKS[reattack_args.driver]:
+            parser.error('attack %s is not supported by %s, choose from %s' % (attack, reattack_args.driver, ', '.join(ATTACKS[reattack_args.driver])))
+    args = driver.get_parser().parse_args(driver_args)
+    if driver.check_args(args):
+        parser.error(driver.check_args(args))
+    print(vars(args), attacks)
+
+    missing = [f for f in required_models(attacks, args) if not os.path.exists(driver.get_export_dir(args) + f)]
+    if missing:
+        print('Missing exported models in %s: %s. Run %s.py with --export_models=1 first' % (driver.get_export_dir(args), ', '.join(missing), reattack_args.driver))
+        sys.exit(1)
+
+    configure_threads(args.intra_op_threads, args.inter_op_threads)
+    with model_storage():
+        reattack(driver, args, attacks)
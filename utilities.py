@@ -1,11 +1,62 @@
-from sklearn.metrics import confusion_matrix, roc_curve
 from constants import SMALL_VALUE, SEED
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import numpy as np
+import contextlib
+import importlib
+import traceback
+import hashlib
+import resource
+import tempfile
 import random
-import matplotlib.pyplot as plt
+import pickle
+import fcntl
+import gzip
+import json
+import time
+import os
+
+class LazyModule(object):
+    # stands in for a module that is imported on first attribute access, so that entry points
+    # only pay for heavy dependencies (TensorFlow, sklearn, matplotlib) on code paths that use them
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+def lazy_import(name):
+    return LazyModule(name)
+
+metrics = lazy_import('sklearn.metrics')
+plt = lazy_import('matplotlib.pyplot')
+
+CPU_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'dpml_cpu_slots')
+
+_cpu_slot_lock = None
+
+_phase_profile = None
+
+# options that do not change the outputs of an experiment, so a run may resume the phases
+# completed by a run that differs only in these
+PHASE_CHECKPOINT_IGNORED_ARGS = ['use_cpu', 'intra_op_threads', 'inter_op_threads', 'cpu_partitions', 'profile_phases', 'checkpoint_phases', 'export_models']
+PHASE_CHECKPOINT_CONFIG = 'phase_config.json'
+# subdirectory of the export directory that holds the checkpoints of a run that exports no models
+PHASE_CHECKPOINT_SUBDIR = 'checkpoints/'
+
+# when set, show_figure saves the figures into this directory instead of showing them
+FIGURE_PATH = None
+_figure_task = None
+_figures_saved = []
+
+# data and tasks of render_figures, inherited by the forked worker processes
+_render = None
 
 def prety_print_result(mem, pred):
-    tn, fp, fn, tp = confusion_matrix(mem, pred).ravel()
+    tn, fp, fn, tp = metrics.confusion_matrix(mem, pred).ravel()
     print('TP: %d     FP: %d     FN: %d     TN: %d' % (tp, fp, fn, tn))
     if tp == fp == 0:
     	print('PPV: 0\nAdvantage: 0')
@@ -13,21 +64,21 @@ def prety_print_result(mem, pred):
     	print('PPV: %.4f\nAdvantage: %.4f' % (tp / (tp + fp), tp / (tp + fn) - fp / (tn + fp)))
 
 def get_ppv(mem, pred):
-    tn, fp, fn, tp = confusion_matrix(mem, pred).ravel()
+    tn, fp, fn, tp = metrics.confusion_matrix(mem, pred).ravel()
     if tp == fp == 0:
     	return 0
     return tp / (tp + fp)
 
 def get_adv(mem, pred):
-    tn, fp, fn, tp = confusion_matrix(mem, pred).ravel()
+    tn, fp, fn, tp = metrics.confusion_matrix(mem, pred).ravel()
     return (tp / (tp + fn)) - (fp / (tn + fp))
 
 def get_fp(mem, pred):
-    tn, fp, fn, tp = confusion_matrix(mem, pred).ravel()
+    tn, fp, fn, tp = metrics.confusion_matrix(mem, pred).ravel()
     return fp
 
 def get_inference_threshold(pred_vector, true_vector, fpr_threshold=None):
-    fpr, tpr, thresholds = roc_curve(true_vector, pred_vector, pos_label=1)
+    fpr, tpr, thresholds = metrics.roc_curve(true_vector, pred_vector, pos_label=1)
     # return inference threshold corresponding to maximum advantage
     if fpr_threshold == None:
     	return thresholds[np.argmax(tpr-fpr)]
@@ -38,6 +89,120 @@ def get_inference_threshold(pred_vector, true_vector, fpr_threshold=None):
     	alpha_thresh = b
     return alpha_thresh
 
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def batch_confusion_counts(membership, preds):
+    # tp, fp, fn and tn of every row of preds at once; membership broadcasts against preds
+    membership, preds = np.asarray(membership, dtype=bool), np.asarray(preds, dtype=bool)
+    tp = np.count_nonzero(preds & membership, axis=-1)
+    fp = np.count_nonzero(preds & ~membership, axis=-1)
+    fn = np.count_nonzero(~preds & membership, axis=-1)
+    return tp, fp, fn, preds.shape[-1] - tp - fp - fn
+
+# index matrix entries drawn at once by bootstrap_metrics, which bounds its memory
+BOOTSTRAP_CHUNK = 1 << 24
+# largest number of runs whose regions run_region_counts enumerates
+MAX_REGION_RUNS = 12
+
+def bootstrap_metrics(membership, pred, n_resamples=1000, confidence=0.95, seed=SEED):
+    # Percentile bootstrap intervals of the TPR, FPR, advantage and PPV of one run's membership
+    # predictions. Each row of the index matrix is a resample of the run's records, and the
+    # confusion counts of all the rows are computed together.
+    membership, pred = np.asarray(membership, dtype=bool), np.asarray(pred, dtype=bool)
+    rng = np.random.default_rng(seed)
+    rows = max(1, BOOTSTRAP_CHUNK // len(membership))
+    counts = []
+    for start in range(0, n_resamples, rows):
+        idx = rng.integers(0, len(membership), size=(min(rows, n_resamples - start), len(membership)), dtype=np.int32)
+        counts.append(batch_confusion_counts(membership[idx], pred[idx]))
+    tp, fp, fn, tn = [np.concatenate(c) for c in zip(*counts)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr, fpr = tp / (tp + fn), fp / (fp + tn)
+        ppv = np.where(tp + fp > 0, tp / (tp + fp), 0)
+    q = 50 * (1 - confidence)
+    return {name: tuple(np.nanpercentile(v, [q, 100 - q])) for name, v in [('tpr', tpr), ('fpr', fpr), ('adv', tpr - fpr), ('ppv', ppv)]}
+
+def print_bootstrap_metrics(label, intervals):
+    print('%s: %s' % (label, '  '.join('%s [%.4f, %.4f]' % (name.upper(), low, high) for name, (low, high) in intervals.items())))
+
+def pack_runs(preds):
+    # one row of packed bits per run, set for the records the run reveals as members
+    return np.packbits(np.asarray(preds, dtype=bool), axis=-1)
+
+def popcount(bits):
+    return POPCOUNT[bits].sum(axis=-1, dtype=np.int64)
+
+def run_region_counts(packed, membership):
+    # Number of members and non-members revealed by exactly the runs in each subset of runs,
+    # indexed by the subset's bit mask (bit i set for run i); index 0 counts records no run reveals.
+    # The 2^runs regions are all enumerated, so this is only for the few runs of a Venn diagram.
+    n_runs = len(packed)
+    if n_runs > MAX_REGION_RUNS:
+        raise ValueError('%d runs have too many regions to enumerate, at most %d are supported' % (n_runs, MAX_REGION_RUNS))
+    subsets = np.arange(1 << n_runs)
+    in_subset = ((subsets[:, np.newaxis] >> np.arange(n_runs)) & 1).astype(bool)
+    # a record is in a region if it is revealed by every run of the subset and by no other run
+    regions = np.bitwise_and.reduce(np.where(in_subset[:, :, np.newaxis], packed, ~packed), axis=1)
+    # the complement also sets the padding bits, which the membership masks clear
+    membership = np.asarray(membership, dtype=bool)
+    return popcount(regions & np.packbits(membership)), popcount(regions & np.packbits(~membership))
+
+def revealed_by_at_least(packed, membership):
+    # tp and fp of the records revealed by at least k runs, for k = 0 .. number of runs, from the
+    # number of runs that reveal each record, so in time linear in the number of runs
+    membership = np.asarray(membership, dtype=bool)
+    n_revealed = np.zeros(len(membership), dtype=np.int32)
+    for bits in packed:
+        n_revealed += np.unpackbits(bits, count=len(membership))
+    ks = np.arange(len(packed) + 1)
+    tp, fp = [np.cumsum(np.bincount(n_revealed[mask], minlength=len(ks))[::-1])[::-1] for mask in (membership, ~membership)]
+    return ks, tp, fp
+
+def search_morgan_thresholds(loss, counts, membership, fpr_threshold=None, n_bins=100, trials=100):
+    # Finds the thresholds of the Morgan attack, which predicts as members the records with
+    # phi_l <= loss < phi_u and merlin count >= phi_m, that maximize the advantage at a false
+    # positive rate of at most fpr_threshold. The candidate loss thresholds are quantiles of
+    # loss. Every (phi_l, phi_u, phi_m) candidate is evaluated at once from the cumulative
+    # counts of a (loss bin, merlin count) histogram.
+    membership = np.asarray(membership, dtype=bool)
+    edges = np.unique(np.quantile(loss, np.linspace(0, 1, n_bins + 1)))
+    edges[-1] = np.inf
+    # bin b holds edges[b] <= loss < edges[b + 1]
+    cells = (np.searchsorted(edges, loss, side='right') - 1) * (trials + 1) + np.rint(counts).astype(np.int64)
+    grid = []
+    for mask in (membership, ~membership):
+        hist = np.bincount(cells[mask], minlength=(len(edges) - 1) * (trials + 1)).reshape(len(edges) - 1, trials + 1)
+        # records of each loss bin with a count of at least m, summed over the loss bins below each edge
+        at_least = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+        below = np.vstack([np.zeros((1, trials + 1), dtype=np.int64), np.cumsum(at_least, axis=0)])
+        # records with edges[l] <= loss < edges[u] and count >= m, indexed by (l, u, m)
+        grid.append(below[np.newaxis, :, :] - below[:, np.newaxis, :])
+    tp, fp = grid
+    tpr, fpr = tp / max(np.sum(membership), 1), fp / max(np.sum(~membership), 1)
+    # only the candidates with phi_l < phi_u select a non-empty loss range
+    valid = np.triu(np.ones((len(edges), len(edges)), dtype=bool), 1)[:, :, np.newaxis]
+    adv = np.where(valid & (fpr <= (1 if fpr_threshold is None else fpr_threshold)), tpr - fpr, -np.inf)
+    l, u, m = np.unravel_index(np.argmax(adv), adv.shape)
+    return edges[l], edges[u], m
+
+def top_k_scores(scores, k):
+    # the k largest probabilities of each record in descending order, in half precision
+    k = min(k, scores.shape[1])
+    top = np.partition(-scores, k - 1, axis=1)[:, :k]
+    return -np.sort(top, axis=1).astype(np.float16)
+
+def save_result(result, path, compress=False):
+    # compressed result files are read back transparently by load_result
+    with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+        pickle.dump(result, f)
+
+def load_result(path):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rb') if compressed else open(path, 'rb')) as f:
+        return pickle.load(f)
+
 def loss_range():
 	return [10**i for i in np.arange(-7, 1, 0.1)]
 
@@ -79,7 +244,287 @@ def generate_noise(shape, dtype, noise_params):
         noise[:, attr] = np.array(np.random.normal(0, noise_magnitude, size=shape[0]), dtype=dtype)
     return noise
 
-def plot_sign_histogram(membership, signs, trials):
+def _noise_bank_attrs_path(path):
+    return path[:-len('.npy')] + '_attrs.npy'
+
+def create_noise_bank(path, shape, noise_params, trials, seed=SEED, workers=None):
+    # Draws the perturbations of all Merlin trials into a float32 .npy file that is memory
+    # mapped by every pass that perturbs the same records. Each trial is drawn from its own
+    # stream spawned from seed, so the trials are generated in parallel and the bank is the
+    # same for a given seed. Full coverage stores a (trials, n, d) array; otherwise only the
+    # (trials, n) values and the attribute perturbed in each trial are stored.
+    if not os.path.exists(path):
+        noise_type, noise_coverage, noise_magnitude = noise_params
+        n, d = shape
+        full = noise_coverage == 'full'
+        streams = np.random.SeedSequence(seed).spawn(trials)
+        attrs = np.zeros(trials, dtype=np.int64)
+        # written under a temporary name, so that concurrent experiments never read a partial bank
+        tmp_path = '%s.%d.tmp.npy' % (path[:-len('.npy')], os.getpid())
+        bank = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(trials, n, d) if full else (trials, n))
+
+        def fill(t):
+            rng = np.random.default_rng(streams[t])
+            if not full:
+                attrs[t] = rng.integers(d)
+            if noise_type == 'uniform':
+                rng.random(out=bank[t], dtype=np.float32)
+            else:
+                rng.standard_normal(out=bank[t], dtype=np.float32)
+            bank[t] *= noise_magnitude
+
+        with ThreadPool(workers or len(os.sched_getaffinity(0))) as pool:
+            pool.map(fill, range(trials))
+        bank.flush()
+        del bank
+        if not full:
+            np.save(tmp_path[:-len('.npy')] + '_attrs.npy', attrs)
+            os.replace(tmp_path[:-len('.npy')] + '_attrs.npy', _noise_bank_attrs_path(path))
+        os.replace(tmp_path, path)
+    return load_noise_bank(path)
+
+def load_noise_bank(path):
+    attrs = np.load(_noise_bank_attrs_path(path)) if os.path.exists(_noise_bank_attrs_path(path)) else None
+    return attrs, np.load(path, mmap_mode='r')
+
+def add_noise(x, noise_bank, t):
+    # perturbs the records with the noise of trial t; a bank can serve any data set with
+    # the same number of features and at most as many records
+    attrs, values = noise_bank
+    if attrs is None:
+        return x + values[t, :len(x)]
+    noisy_x = np.copy(x)
+    noisy_x[:, attrs[t]] += values[t, :len(x)]
+    return noisy_x
+
+def claim_cpu_partition(n_partitions, lock_dir=CPU_LOCK_DIR):
+    # Splits the cores available to this process into n_partitions disjoint sets and pins
+    # the process to the first set no other process on the node holds. Slots are flock-ed
+    # files, so they are released when the process exits, even if it crashes. Waits for
+    # a slot if all of them are taken.
+    global _cpu_slot_lock
+    cores = sorted(os.sched_getaffinity(0))
+    partitions = np.array_split(cores, min(n_partitions, len(cores)))
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    locks = [open(os.path.join(lock_dir, 'slot_%d_of_%d.lock' % (i, len(partitions))), 'w') for i in range(len(partitions))]
+    slot = None
+    for i, f in enumerate(locks):
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            slot = i
+            break
+        except OSError:
+            pass
+    if slot is None:
+        slot = os.getpid() % len(partitions)
+        print('All %d CPU partitions are in use, waiting for partition %d' % (len(partitions), slot))
+        fcntl.flock(locks[slot], fcntl.LOCK_EX)
+    for i, f in enumerate(locks):
+        if i != slot:
+            f.close()
+    _cpu_slot_lock = locks[slot]
+    os.sched_setaffinity(0, [int(c) for c in partitions[slot]])
+    print('Using CPU partition %d of %d: cores %s' % (slot, len(partitions), list(partitions[slot])))
+    return list(partitions[slot])
+
+def start_phase_profile():
+    # Phases entered after this call are recorded until save_phase_profile is called
+    global _phase_profile
+    _phase_profile = []
+
+@contextlib.contextmanager
+def profile_phase(name, n_records=0, enabled=True):
+    # Records wall-clock time, CPU time of all threads, peak resident memory and
+    # throughput of the enclosed block. No-op unless start_phase_profile was called,
+    # or when not enabled, e.g. in a thread whose phases would overlap with others.
+    if _phase_profile is None or not enabled:
+        yield
+        return
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        _phase_profile.append({
+            'phase': name,
+            'wall_time': wall_time,
+            'cpu_time': time.process_time() - cpu_start,
+            # ru_maxrss is reported in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'n_records': n_records,
+            'records_per_sec': n_records / wall_time if wall_time > 0 else 0,
+            'completed': completed})
+
+def save_phase_profile(path):
+    # also called when the experiment failed, to keep the phases it did run; profiling stops
+    # even if the profile cannot be written
+    global _phase_profile
+    phases, _phase_profile = _phase_profile, None
+    if phases is None:
+        return
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'phases': phases, 'total_wall_time': sum(p['wall_time'] for p in phases)}, f, indent=2)
+    print('Phase profile written to ' + path)
+    for p in phases:
+        print('%-28s wall %8.2fs  cpu %8.2fs  peak rss %8.1f MB  %10.1f records/s%s' % (p['phase'], p['wall_time'], p['cpu_time'], p['peak_rss_mb'], p['records_per_sec'], '' if p['completed'] else '  (failed)'))
+
+def show_figure(name):
+    # Shows the current figure, or saves it as FIGURE_PATH/<task>_<name>.pdf when rendering to files
+    # (FIGURE_PATH/<name>.pdf for the figure named after its task)
+    if FIGURE_PATH is None:
+        plt.show()
+        return
+    path = os.path.join(FIGURE_PATH, (name if name == _figure_task else _figure_task + '_' + name) + '.pdf')
+    plt.savefig(path)
+    plt.close('all')
+    _figures_saved.append(path)
+
+def _render_fingerprint(name, fn_args, settings, inputs, sources):
+    # result files are identified by size and modification time, so that they are not read
+    # again; the code that draws the figures is hashed
+    h = hashlib.sha1(json.dumps([name, repr(fn_args), settings]).encode())
+    for path in inputs:
+        st = os.stat(path)
+        h.update(('%s %d %d' % (path, st.st_size, st.st_mtime_ns)).encode())
+    for path in sources:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _render_task(i):
+    global FIGURE_PATH, _figure_task, _figures_saved
+    result, out_dir, tasks = _render
+    name, fn, fn_args, _ = tasks[i]
+    FIGURE_PATH, _figure_task, _figures_saved = out_dir, name, []
+    text_path = os.path.join(out_dir, name + '.txt')
+    try:
+        # the tables printed by the task are kept next to its figures
+        with open(text_path, 'w') as f, contextlib.redirect_stdout(f):
+            fn(result, *fn_args)
+    except Exception:
+        return name, None, traceback.format_exc()
+    return name, _figures_saved + [text_path], None
+
+def render_figures(tasks, load, out_dir, workers=0, settings=None, sources=()):
+    # Renders the (name, function, arguments, input files) tasks into out_dir with a non-interactive
+    # backend, calling function(data, *arguments) in parallel worker processes. The data is loaded
+    # once by load() and inherited by the forked workers. Tasks whose input files, settings and
+    # sources are unchanged since they were last rendered are skipped. Returns the failed tasks.
+    global _render
+    import matplotlib
+    matplotlib.use('Agg')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    sources = list(sources) + [os.path.abspath(__file__)]
+    stale, fingerprints = [], {}
+    for name, fn, fn_args, inputs in tasks:
+        fingerprints[name] = _render_fingerprint(name, fn_args, settings, inputs, sources)
+        entry = manifest.get(name)
+        if entry and entry['fingerprint'] == fingerprints[name] and all(os.path.exists(p) for p in entry['files']):
+            print('Skipping %s: inputs unchanged' % name)
+            continue
+        stale.append((name, fn, fn_args, inputs))
+    failed = []
+    if not stale:
+        return failed
+    _render = (load(), out_dir, stale)
+    # a fresh process per task, so that the pyplot state of one task does not leak into the next
+    pool = multiprocessing.get_context('fork').Pool(workers or min(len(stale), os.cpu_count()), maxtasksperchild=1)
+    try:
+        for name, files, error in pool.imap_unordered(_render_task, range(len(stale))):
+            if error:
+                print('Failed to render %s:\n%s' % (name, error))
+                failed.append(name)
+                manifest.pop(name, None)
+                continue
+            print('Rendered %s: %s' % (name, ', '.join(os.path.basename(path) for path in files)))
+            manifest[name] = {'fingerprint': fingerprints[name], 'files': files}
+            # the manifest is replaced after every task, so an interrupted run keeps its progress
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_path + '.tmp', manifest_path)
+    finally:
+        pool.close()
+        pool.join()
+        _render = None
+    return failed
+
+def is_phase_checkpoint_file(name):
+    # the files of the phase checkpoints, as opposed to the exported models next to them
+    return name.endswith('.p') or name.endswith('.tmp') or name == PHASE_CHECKPOINT_CONFIG
+
+def open_phase_checkpoints(checkpoint_dir, args):
+    # Checkpoints saved in checkpoint_dir by a run of another configuration are discarded. The
+    # models exported next to them are kept, but are not resumed (see is_resumable_model).
+    if checkpoint_dir is None:
+        return
+    config = {k: v for k, v in sorted(vars(args).items()) if k not in PHASE_CHECKPOINT_IGNORED_ARGS}
+    path = os.path.join(checkpoint_dir, PHASE_CHECKPOINT_CONFIG)
+    saved = None
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+    if saved != config:
+        stale = [name for name in os.listdir(checkpoint_dir) if is_phase_checkpoint_file(name)]
+        if stale:
+            print('Discarding the checkpoints of another configuration in ' + checkpoint_dir)
+        for name in stale:
+            os.remove(os.path.join(checkpoint_dir, name))
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=2)
+
+def is_resumable_model(model_dir, name):
+    # A model exported to a directory of phase checkpoints is resumed only if it was written after
+    # the checkpoints were opened, and so by a run of their configuration
+    path = os.path.join(model_dir, name)
+    config = os.path.join(model_dir, PHASE_CHECKPOINT_CONFIG)
+    return os.path.exists(path) and (not os.path.exists(config) or os.path.getmtime(path) >= os.path.getmtime(config))
+
+def run_phase(checkpoint_dir, name, fn):
+    # Returns the outputs of fn(), which are pickled to checkpoint_dir/name.p as soon as it
+    # returns. When that file exists, a previous run completed the phase and its outputs are
+    # returned without calling fn. Without a checkpoint_dir, fn is simply called.
+    if checkpoint_dir is None:
+        return fn()
+    path = os.path.join(checkpoint_dir, name + '.p')
+    if os.path.exists(path):
+        print('-' * 10 + 'RESUMING COMPLETED PHASE ' + name.upper() + '-' * 10 + '\n')
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    outputs = fn()
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(outputs, f)
+    os.replace(path + '.tmp', path)
+    return outputs
+
+def clear_phase_checkpoints(checkpoint_dir, keep_models=False):
+    # Called once the results of the experiment are written. The models exported by this run
+    # are kept if keep_models is set, and those exported by earlier runs are always kept.
+    if checkpoint_dir is None:
+        return
+    # this run's models are told apart by the config file, which is removed last
+    names = sorted(os.listdir(checkpoint_dir), key=lambda name: name == PHASE_CHECKPOINT_CONFIG)
+    for name in names:
+        if is_phase_checkpoint_file(name) or (not keep_models and is_resumable_model(checkpoint_dir, name)):
+            os.remove(os.path.join(checkpoint_dir, name))
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+        # as is the export directory that only held the checkpoint subdirectory
+        parent = os.path.dirname(os.path.normpath(checkpoint_dir))
+        if os.path.normpath(checkpoint_dir).endswith(os.path.normpath(PHASE_CHECKPOINT_SUBDIR)) and not os.listdir(parent):
+            os.rmdir(parent)
+
+def plot_sign_histogram(membership, signs, trials, name='merlin_ratio_histogram'):
     signs = np.array(signs, dtype='int32')
     mem, non_mem = np.zeros(trials + 1), np.zeros(trials + 1)
     mem_size, non_mem_size = sum(membership), len(membership) - sum(membership)
@@ -98,9 +543,9 @@ def plot_sign_histogram(membership, signs, trials):
     plt.ylim(0, 0.1)
     plt.legend()
     plt.tight_layout()
-    plt.show()
+    show_figure(name)
 
-def plot_histogram(vector):
+def plot_histogram(vector, name='loss_histogram'):
     mem = vector[:10000]
     non_mem = vector[10000:]
     data, bins, _ = plt.hist([mem, non_mem], bins=loss_range())
@@ -117,15 +562,15 @@ def plot_histogram(vector):
     plt.ylabel('Fraction of Instances')
     plt.legend()
     plt.tight_layout()
-    plt.show()
+    show_figure(name)
 
-def make_membership_box_plot(vector):
+def make_membership_box_plot(vector, name='membership_box_plot'):
     plt.boxplot([vector[:10000], vector[10000:]], labels=['members', 'non-members'], whis='range')
     plt.yscale('log')
     plt.ylabel('Per-Instance Loss')
-    plt.show()
+    show_figure(name)
 
-def make_predictions_box_plot(vector, mem, pred_mem):
+def make_predictions_box_plot(vector, mem, pred_mem, name='predictions_box_plot'):
     tp_vec = [vector[i] for i in range(len(vector)) if mem[i] == 1 and pred_mem[i] == 1]
     fn_vec = [vector[i] for i in range(len(vector)) if mem[i] == 1 and pred_mem[i] == 0]
     fp_vec = [vector[i] for i in range(len(vector)) if mem[i] == 0 and pred_mem[i] == 1]
@@ -133,4 +578,4 @@ def make_predictions_box_plot(vector, mem, pred_mem):
     plt.boxplot([tp_vec, fn_vec, fp_vec, tn_vec], labels=['TP', 'FN', 'FP', 'TN'], whis='range')
     plt.yscale('log')
     plt.ylabel('Per-Instance Loss')
-    plt.show()
\ No newline at end of file
+    show_figure(name)
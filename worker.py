@@ -0,0 +1,235 @@
+import attack
+import evaluating_dpml
+import improved_mi
+from attack import save_data
+from classifier import model_storage, configure_threads
+from utilities import claim_cpu_partition, start_phase_profile, save_phase_profile
+import traceback
+import threading
+import argparse
+import hashlib
+import socket
+import uuid
+import shlex
+import json
+import time
+import sys
+import os
+
+DRIVERS = {'evaluating_dpml': evaluating_dpml, 'improved_mi': improved_mi}
+# a job file moves from pending to running when a worker claims it, and then to done or failed;
+# while running, its name ends with OWNER_SEPARATOR and the token of the worker's claim
+QUEUE_STATES = ['pending', 'running', 'done', 'failed']
+POLL_INTERVAL = 10 # seconds between checks of a queue whose remaining jobs are all running
+OWNER_SEPARATOR = '@'
+
+
+def read_jobs(jobs_file):
+    # one experiment per line, with the same arguments as the driver's command line;
+    # blank lines and lines starting with # are skipped
+    with (sys.stdin if jobs_file == '-' else open(jobs_file)) as f:
+        return [shlex.split(line) for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def parse_jobs(driver, jobs):
+    # all jobs are parsed and checked before any runs, so a malformed line is reported up front
+    parsed, invalid = [], []
+    for job_args in jobs:
+        try:
+            args = driver.get_parser().parse_args(job_args)
+        except SystemExit:
+            invalid.append(' '.join(job_args))
+            continue
+        if driver.check_args(args):
+            print('Invalid job %s: %s' % (' '.join(job_args), driver.check_args(args)))
+            invalid.append(' '.join(job_args))
+            continue
+        parsed.append((job_args, args))
+    return parsed, invalid
+
+
+def run_job(driver, args):
+    print(vars(args))
+    if args.save_data:
+        save_data(args)
+        # the splits on disk have changed
+        attack.DATA_CACHE.clear()
+        return
+    if args.profile_phases:
+        start_phase_profile()
+    try:
+        with model_storage():
+            driver.run_experiment(args)
+    finally:
+        # a failed job's profile is written to its own path, and not carried over to the next job
+        save_phase_profile(os.path.splitext(driver.get_result_path(args))[0] + '_phases.json')
+
+
+def enqueue_jobs(queue_dir, driver_name, jobs):
+    # Adds the jobs to the queue in order. A job that is already in the queue, in any state, is
+    # not added again, so enqueueing the same jobs file twice is harmless.
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+    queued = set(name.split(OWNER_SEPARATOR)[0].split('-')[-1] for state in QUEUE_STATES for name in os.listdir(os.path.join(queue_dir, state)))
+    batch = int(time.time())
+    n_added = 0
+    for i, job_args in enumerate(jobs):
+        job = {'driver': driver_name, 'args': job_args}
+        digest = hashlib.sha1(json.dumps(job).encode()).hexdigest()[:16] + '.json'
+        if digest in queued:
+            continue
+        queued.add(digest)
+        # jobs are claimed in the order of their names
+        name = '%d-%06d-%s' % (batch, i, digest)
+        with open(os.path.join(queue_dir, name + '.tmp'), 'w') as f:
+            json.dump(job, f)
+        os.rename(os.path.join(queue_dir, name + '.tmp'), os.path.join(queue_dir, 'pending', name))
+        n_added += 1
+    return n_added
+
+
+def claim_job(queue_dir):
+    # The rename from pending to running is atomic, so exactly one worker claims each job. The
+    # running file is named after the claim, so once its lease has expired and the job has been
+    # claimed again, the previous owner's path no longer exists.
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'pending'))):
+        path = os.path.join(queue_dir, 'running', name + OWNER_SEPARATOR + uuid.uuid4().hex)
+        try:
+            os.rename(os.path.join(queue_dir, 'pending', name), path)
+            # the modification time of a running job is its lease, which starts now
+            os.utime(path)
+        except FileNotFoundError:
+            continue # claimed by another worker first
+        return name, path
+    return None, None
+
+
+def hold_lease(path, interval, stop):
+    # renews the lease on a running job until the job finishes
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            print('Lost the lease on ' + path)
+            return
+
+
+def reclaim_expired_jobs(queue_dir, lease):
+    # Jobs whose worker stopped renewing their lease (e.g. its node failed) are put back in
+    # pending. A job may therefore run more than once, which rewrites the same result file.
+    for name in os.listdir(os.path.join(queue_dir, 'running')):
+        path = os.path.join(queue_dir, 'running', name)
+        try:
+            if time.time() - os.stat(path).st_mtime > lease:
+                os.rename(path, os.path.join(queue_dir, 'pending', name.split(OWNER_SEPARATOR)[0]))
+                print('Reclaimed the expired lease on ' + name)
+        except FileNotFoundError:
+            pass # finished or reclaimed by another worker
+
+
+def run_queue(queue_dir, lease):
+    # Runs jobs from the queue until no job is pending or running. Any number of workers, on any
+    # node that shares queue_dir and the working directory, can run the same queue.
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    completed, failed = 0, 0
+    while True:
+        reclaim_expired_jobs(queue_dir, lease)
+        name, path = claim_job(queue_dir)
+        if name is None:
+            if not os.listdir(os.path.join(queue_dir, 'running')):
+                break
+            # a job still running elsewhere is claimed again if its lease expires
+            time.sleep(POLL_INTERVAL)
+            continue
+        with open(path) as f:
+            job = json.load(f)
+        print('-' * 10 + 'JOB %s CLAIMED BY %s: %s %s' % (name, worker, job['driver'], ' '.join(job['args'])) + '-' * 10 + '\n')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=hold_lease, args=(path, lease / 4, stop), daemon=True)
+        heartbeat.start()
+        start = time.time()
+        error = None
+        try:
+            driver = DRIVERS[job['driver']]
+            try:
+                args = driver.get_parser().parse_args(job['args'])
+            except SystemExit:
+                raise ValueError('invalid arguments: ' + ' '.join(job['args']))
+            run_job(driver, args)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            stop.set()
+            heartbeat.join()
+        state = 'failed' if error else 'done'
+        try:
+            # only succeeds while this worker still owns the job
+            os.rename(path, os.path.join(queue_dir, state, name))
+        except FileNotFoundError:
+            # the job was reclaimed, and its new owner records its outcome
+            print('The lease on %s expired while it was running, its outcome is dropped' % name)
+            continue
+        if error:
+            with open(os.path.join(queue_dir, 'failed', name + '.log'), 'w') as f:
+                f.write(error)
+        completed += not error
+        failed += bool(error)
+        print('Job %s %s in %.1fs' % (name, state, time.time() - start))
+    print('-' * 10 + 'QUEUE EMPTY: %d JOBS COMPLETED, %d FAILED BY %s' % (completed, failed, worker) + '-' * 10)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # a jobs file to run locally or to add to the queue; a queue worker takes none
+    parser.add_argument('jobs', type=str, nargs='?', default=None)
+    parser.add_argument('--driver', type=str, default='evaluating_dpml', choices=list(DRIVERS))
+    parser.add_argument('--queue_dir', type=str, default=None)
+    parser.add_argument('--enqueue', type=int, default=0)
+    parser.add_argument('--lease', type=int, default=600)
+    # thread configuration applies to the whole worker; the per-job flags are ignored
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--cpu_partitions', type=int, default=0)
+    args = parser.parse_args()
+    print(vars(args))
+
+    if args.enqueue:
+        if args.queue_dir is None or args.jobs is None:
+            parser.error('--enqueue needs a jobs file and a --queue_dir')
+        n_added = enqueue_jobs(args.queue_dir, args.driver, read_jobs(args.jobs))
+        print('Added %d jobs to %s' % (n_added, args.queue_dir))
+        sys.exit(0)
+    if args.jobs is None and args.queue_dir is None:
+        parser.error('give a jobs file or a --queue_dir')
+
+    if args.cpu_partitions:
+        cores = claim_cpu_partition(args.cpu_partitions)
+        args.intra_op_threads = args.intra_op_threads or len(cores)
+        args.inter_op_threads = args.inter_op_threads or min(2, len(cores))
+    configure_threads(args.intra_op_threads, args.inter_op_threads)
+
+    # data sets are read from disk once and shared by all the jobs
+    attack.DATA_CACHE = {}
+    if args.queue_dir is not None:
+        sys.exit(1 if run_queue(args.queue_dir, args.lease) else 0)
+
+    driver = DRIVERS[args.driver]
+    jobs, failed = parse_jobs(driver, read_jobs(args.jobs))
+    n_jobs = len(jobs) + len(failed)
+    for i, (job_args, job) in enumerate(jobs, 1):
+        print('-' * 10 + 'JOB %d OF %d: %s' % (i, len(jobs), ' '.join(job_args)) + '-' * 10 + '\n')
+        start = time.time()
+        try:
+            run_job(driver, job)
+        except Exception:
+            # a failing configuration does not stop the remaining jobs
+            traceback.print_exc()
+            failed.append(' '.join(job_args))
+        print('Job %d finished in %.1fs' % (i, time.time() - start))
+
+    print('-' * 10 + 'COMPLETED %d OF %d JOBS' % (n_jobs - len(failed), n_jobs) + '-' * 10)
+    for job in failed:
+        print('Failed: ' + job)
+    sys.exit(1 if failed else 0)